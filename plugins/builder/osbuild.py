@@ -1,4 +1,5 @@
 #!/usr/bin/python3
+# pylint: disable=too-many-lines
 """Koji osbuild integration - builder plugin
 
 This koji builder plugin provides a handler for 'osbuildImage' tasks,
@@ -12,19 +13,34 @@ koji integration to talk to composer.
 
 This file can also be used as an executable where it acts as a stand
 alone client for composer's API.
+
+The plugin is loaded by every kojid process; modules that are not
+already needed by koji itself and are only used while running a task,
+or by the stand alone client, are imported on first use.
 """
 
 
 import configparser
+import copy
+import email.utils
+import fcntl
+import hashlib
 import io
 import json
+import os
+import queue
+import random
+import signal
+import socket
+import socketserver
 import sys
+import threading
 import time
 import logging
 import urllib.parse
 
 from string import Template
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import requests
 import koji
@@ -186,6 +202,20 @@ class ComposeRequest:
             res["customizations"] = self.customizations
         return res
 
+    def digest(self, *, with_release: bool = False) -> str:
+        """Digest of the content of the request
+
+        The task id, which differs for every build of the same content,
+        is not included; neither is the release, unless `with_release`
+        is set, e.g. because it was explicitly requested.
+        """
+        data = self.as_dict()
+        data["koji"].pop("task_id", None)
+        if not with_release:
+            data["koji"].pop("release", None)
+        js = json.dumps(data, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(js.encode("utf-8")).hexdigest()
+
 
 class ComposeStatusError:
     def __init__(self, error_id: int, reason: str, details: Optional[Dict]=None):
@@ -241,6 +271,8 @@ class ComposeStatus:
         self.images = images
         self.koji_task_id = task_id
         self.koji_build_id = build_id
+        # Server provided hint, in seconds, for when to poll again
+        self.poll_hint: Optional[float] = None
 
     @classmethod
     def from_dict(cls, data: Dict):
@@ -267,6 +299,19 @@ class ComposeStatus:
 
         return data
 
+    def as_api_dict(self):
+        """Serialize in the format of composer's API, see `from_dict`"""
+        return {
+            "status": self.status,
+            "koji_status": {
+                "task_id": self.koji_task_id,
+                "build_id": self.koji_build_id
+            },
+            "image_statuses": [
+                img.as_dict() for img in self.images
+            ]
+        }
+
     @property
     def is_finished(self):
         if self.is_success:
@@ -277,6 +322,10 @@ class ComposeStatus:
     def is_success(self):
         return self.status in [self.SUCCESS]
 
+    @property
+    def has_failed_image(self):
+        return any(img.status == self.FAILURE for img in self.images)
+
 
 class ComposeLogs:
     def __init__(self, image_logs: List, import_logs, init_logs):
@@ -293,6 +342,151 @@ class ComposeLogs:
         return cls(image_logs, import_logs, init_logs)
 
 
+class PollStrategy:
+    """Poll the compose status at a fixed interval
+
+    Base class for all polling strategies. Before each new status
+    request the strategy is asked for the time to wait via `next_delay`,
+    which is told if the status changed since the last poll and given
+    an optional hint by the server, i.e. via `Retry-After`. The hint is
+    treated as the minimal delay.
+
+    Strategies carry state and thus every compose that is waited for
+    should use its own copy, see `clone`.
+    """
+
+    name = "fixed"
+
+    # the config keys used by the strategy, others are ignored
+    KEYS = ("interval",)
+
+    def __init__(self, interval: float = 2) -> None:
+        self.interval = interval
+
+    @classmethod
+    def from_config(cls, cfg) -> "PollStrategy":
+        """Create a strategy from a config section or dictionary"""
+        name = cfg.get("strategy", cls.name)
+        klass = POLL_STRATEGIES.get(name)
+        if not klass:
+            raise ValueError(f"Unknown polling strategy '{name}'")
+
+        args = {k: float(cfg[k]) for k in klass.KEYS if cfg.get(k) is not None}
+        return klass(**args)
+
+    def clone(self) -> "PollStrategy":
+        res = copy.copy(self)
+        res.reset()
+        return res
+
+    def reset(self):
+        """Reset the state, called when the status changed"""
+
+    def delay(self) -> float:
+        return self.interval
+
+    def limit_hint(self, hint: float) -> float:
+        return hint
+
+    def next_delay(self, changed: bool, hint: Optional[float] = None) -> float:
+        if changed:
+            self.reset()
+
+        delay = self.delay()
+        if hint is not None:
+            delay = max(delay, self.limit_hint(hint))
+        return delay
+
+
+class BackoffPollStrategy(PollStrategy):
+    """Poll the compose status with exponential backoff
+
+    The delay starts at `interval` and grows by `factor` with every
+    poll that did not result in a change of the status, up to a
+    maximum of `max_interval`. Whenever the status changes the delay
+    is reset to `interval`. A random `jitter` (fraction of the delay)
+    is applied to avoid synchronized requests from many tasks.
+    Server hints are also capped at `max_interval`.
+    """
+
+    name = "backoff"
+
+    KEYS = ("interval", "max_interval", "factor", "jitter")
+
+    def __init__(self, interval: float = 2, max_interval: float = 60,
+                 factor: float = 2, jitter: float = 0.1) -> None:
+        super().__init__(interval)
+        self.max_interval = max(max_interval, interval)
+        self.factor = factor
+        self.jitter = jitter
+        self.current = interval
+
+    def reset(self):
+        self.current = self.interval
+
+    def delay(self) -> float:
+        delay = self.current
+        self.current = min(self.current * self.factor, self.max_interval)
+        if self.jitter:
+            delay += delay * random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0)
+
+    def limit_hint(self, hint: float) -> float:
+        return min(hint, self.max_interval)
+
+
+POLL_STRATEGIES = {
+    PollStrategy.name: PollStrategy,
+    BackoffPollStrategy.name: BackoffPollStrategy,
+}
+
+
+class SharedState:
+    """JSON document shared between processes on the same host
+
+    To be used as context manager, which takes an exclusive lock, via
+    `flock` on a separate lock file, for the duration of the `with`
+    block. The document is available as `data`, an empty dictionary if
+    it does not exist yet or is not readable, and must explicitly be
+    written back via `save`, which replaces the file atomically.
+    The files are only readable by the current user.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data: Dict = {}
+        self.fd: Optional[int] = None
+
+    def __enter__(self) -> "SharedState":
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+        if not isinstance(self.data, dict):
+            self.data = {}
+
+        return self
+
+    def __exit__(self, *args):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+
 class OAuth2(requests.auth.AuthBase):
     """Auth provider for requests supporting OAuth2 client credentials
 
@@ -301,7 +495,13 @@ class OAuth2(requests.auth.AuthBase):
     are the client id, client secret and the token url.
 
     Automatic refreshing of the token is supported if the token was
-    acquired specified a `expires_in` field.
+    acquired specified a `expires_in` field. The token is refreshed
+    proactively once the `refresh_at` fraction of its lifetime passed.
+
+    If `cache` is given, tokens are shared between all processes on
+    the same host via a `SharedState` at that path. Only one process at
+    a time fetches a new token, the others will wait for and then use
+    the token it obtained.
 
     Currently, this implementation does not support a actual "refresh
     token".
@@ -318,25 +518,73 @@ class OAuth2(requests.auth.AuthBase):
 
             self.created = created
 
-        @property
-        def expired(self) -> bool:
+        def as_dict(self) -> Dict:
+            return {
+                "access_token": self.data,
+                "token_type": self.type,
+                "expires_in": self.expires_in,
+                "scope": self.scope,
+                "created": self.created
+            }
+
+        @classmethod
+        def from_dict(cls, data: Dict) -> "OAuth2.Token":
+            return cls(data, data["created"])
+
+        def stale(self, fraction: float = 1.0) -> bool:
             if not self.expires_in:
                 return False
 
             now = time.time()
-            return now > self.created + self.expires_in
+            return now > self.created + self.expires_in * fraction
 
-    def __init__(self, cid: str, secret: str, token_url: str) -> None:
+        @property
+        def expired(self) -> bool:
+            return self.stale()
+
+    def __init__(self, cid: str, secret: str, token_url: str, *,
+                 cache: Optional[str] = None, refresh_at: float = 0.8,
+                 timeout: Optional[Tuple[float, float]] = None) -> None:
         self.id = cid
         self.secret = secret
         self.token_url = token_url
         self.token = None
+        self.lock = threading.Lock()
+        self.cache = cache
+        self.refresh_at = refresh_at
+        self.timeout = timeout
 
     @property
     def token_expired(self) -> bool:
-        return not self.token or self.token.expired
+        return not self.token or self.token.stale(self.refresh_at)
+
+    def fetch_token(self, http: requests.Session, force: bool = False):
+        if not self.cache:
+            self.token = self.request_token(http)
+            return
 
-    def fetch_token(self, http: requests.Session):
+        key = f"{self.token_url}|{self.id}"
+        with SharedState(self.cache) as state:
+            cached = state.data.get(key)
+            if cached:
+                try:
+                    token = self.Token.from_dict(cached)
+                except (KeyError, TypeError, ValueError):
+                    token = None
+
+                # If a new token is forced, i.e. the current one got
+                # rejected, only use a token from the cache that is
+                # different from our current one
+                rejected = force and self.token and token and token.data == self.token.data
+                if token and not token.stale(self.refresh_at) and not rejected:
+                    self.token = token
+                    return
+
+            self.token = self.request_token(http)
+            state.data[key] = self.token.as_dict()
+            state.save()
+
+    def request_token(self, http: requests.Session) -> "OAuth2.Token":
         # Set token creation time here. If we set it after the request was
         # fulfilled, it would be offsetted by the time it took the token to
         # get from the server here, which can result into us refreshing
@@ -348,14 +596,14 @@ class OAuth2(requests.auth.AuthBase):
             "client_secret": self.secret
         }
 
-        res = http.post(self.token_url, data=data)
+        res = http.post(self.token_url, data=data, timeout=self.timeout)
         if res.status_code != 200:
             body = res.content.decode("utf-8").strip()
             msg = f"Failed to authenticate via SSO/OAuth: {body}"
             raise koji.GenericError(msg) from None
 
         token_data = res.json()
-        self.token = self.Token(token_data, token_created)
+        return self.Token(token_data, token_created)
 
     def __call__(self, r: requests.Request):
         """Called by requests to obtain authorization"""
@@ -368,19 +616,203 @@ class OAuth2(requests.auth.AuthBase):
         return r
 
 
+class RequestFailed(koji.GenericError):
+    """A request to composer failed to connect or timed out"""
+
+
+class DeadlineExceeded(koji.GenericError):
+    """The compose did not finish before the deadline"""
+
+    def __init__(self, compose_id: str):
+        super().__init__(f"Compose {compose_id} did not finish in time")
+
+
+class CircuitOpen(RequestFailed):
+    """A request was not sent since the circuit breaker of composer is open"""
+
+    def __init__(self, server: str, retry_in: float):
+        super().__init__(f"Composer {server} is unavailable, retrying in {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Circuit breaker for the requests to a composer
+
+    After `threshold` consecutive requests failed, i.e. failed to connect,
+    timed out or got a server error (even after the retries of urllib3),
+    the breaker opens: requests fail right away with `CircuitOpen`,
+    without reaching composer. After `reset_timeout` seconds the breaker
+    is half-open and a single request is let through as probe. If it
+    succeeds, the breaker is closed again, otherwise it opens for another
+    `reset_timeout` seconds.
+
+    The state is kept per composer and, if `path` is given, in a
+    `SharedState` file so it is shared by all tasks on the builder.
+    The number of times the breaker opened (`trips`) and of rejected
+    requests (`rejected`) are recorded as metrics, see `stats`.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, server: str, *, threshold: int = 5, reset_timeout: float = 30,
+                 path: Optional[str] = None):
+        self.server = server
+        self.threshold = max(threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.path = path
+        self.data: Dict = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('koji.plugin.osbuild')
+
+    def update(self, fn):
+        """Call `fn` with the state of the breaker, saving any change"""
+        with self.lock:
+            if not self.path:
+                return fn(self.data)
+
+            with SharedState(self.path) as shared:
+                entry = shared.data.setdefault(self.server, {})
+                before = dict(entry)
+                try:
+                    return fn(entry)
+                finally:
+                    if entry != before:
+                        shared.save()
+
+    def stats(self) -> Dict:
+        """The state and metrics of the breaker"""
+        def get(entry):
+            return {
+                "state": entry.get("state", self.CLOSED),
+                "failures": entry.get("failures", 0),
+                "trips": entry.get("trips", 0),
+                "rejected": entry.get("rejected", 0),
+                "tripped": entry.get("tripped")
+            }
+        return self.update(get)
+
+    def before_request(self):
+        """Check if a request can be sent, raises `CircuitOpen` if not"""
+        now = time.time()
+
+        def check(entry) -> float:
+            if entry.get("state", self.CLOSED) == self.CLOSED:
+                return 0
+            retry_at = entry.get("retry_at", 0)
+            if now < retry_at:
+                entry["rejected"] = entry.get("rejected", 0) + 1
+                return retry_at - now
+            # let this request through as probe; all others are still
+            # rejected until it is done or did not report back in time
+            entry["state"] = self.HALF_OPEN
+            entry["retry_at"] = now + self.reset_timeout
+            return 0
+
+        retry_in = self.update(check)
+        if retry_in:
+            raise CircuitOpen(self.server, retry_in)
+
+    def record(self, success: bool):
+        """Record the outcome of a request"""
+        now = time.time()
+
+        def succeeded(entry):
+            if entry.get("state", self.CLOSED) != self.CLOSED:
+                self.logger.info("Composer %s is available again", self.server)
+            entry["state"] = self.CLOSED
+            entry["failures"] = 0
+
+        def failed(entry):
+            state = entry.get("state", self.CLOSED)
+            entry["failures"] = entry.get("failures", 0) + 1
+            if state == self.OPEN:
+                # a request sent before the breaker opened
+                return
+            if state == self.CLOSED and entry["failures"] < self.threshold:
+                return
+            entry["state"] = self.OPEN
+            entry["retry_at"] = now + self.reset_timeout
+            entry["trips"] = entry.get("trips", 0) + 1
+            entry["tripped"] = now
+            self.logger.warning("Composer %s is unavailable after %d failed requests, "
+                                "pausing requests for %.1fs (trips: %d)", self.server,
+                                entry["failures"], self.reset_timeout, entry["trips"])
+
+        self.update(succeeded if success else failed)
+
+
+class ComposerRetry(Retry):
+    """Retry policy for the requests to composer
+
+    If 429 (Too Many Requests) is one of the retried status codes, such
+    requests are retried regardless of their method, since composer did
+    not process them.
+    The time composer asked to wait via `Retry-After` is honored, up to
+    `RETRY_AFTER_MAX` seconds; otherwise the backoff time is varied by
+    a random `jitter`, a fraction of it, so that clients that failed at
+    the same time do not all retry at the same time.
+    """
+
+    RETRY_AFTER_MAX = 300.0
+
+    def __init__(self, *args, jitter: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jitter = jitter
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.jitter = self.jitter
+        return retry
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total and 429 in (self.status_forcelist or ()):
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.RETRY_AFTER_MAX)
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if not self.jitter:
+            return backoff
+        return backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
 class Client:
-    def __init__(self, url, retries_total=15, retries_backoff_factor=0.3):
+    # (connect, read) timeout in seconds for all requests
+    TIMEOUT = (10.0, 120.0)
+
+    # status codes of responses that are retried
+    RETRY_STATUS = [429, 500, 502, 503, 504]
+
+    # seconds composer may be unreachable while waiting without a deadline
+    UNREACHABLE_MAX = 3600.0
+
+    def __init__(self, url, retries_total=15, retries_backoff_factor=0.3, *,
+                 retries_status: Optional[List[int]] = None,
+                 retries_jitter: float = 0.1):
         self.server = url
         self.url = urllib.parse.urljoin(url, API_BASE)
         self.http = requests.Session()
 
-        retries = Retry(total=retries_total,
-                        backoff_factor=retries_backoff_factor,
-                        status_forcelist=[500, 502, 503, 504],
-                        raise_on_status=False
-                        )
+        retries = ComposerRetry(total=retries_total,
+                                backoff_factor=retries_backoff_factor,
+                                status_forcelist=(self.RETRY_STATUS if retries_status is None
+                                                  else retries_status),
+                                raise_on_status=False,
+                                jitter=retries_jitter
+                                )
 
         self.http.mount(self.server, HTTPAdapter(max_retries=retries))
+        self.poll_strategy = PollStrategy()
+        self.timeout = self.TIMEOUT
+        self.breaker: Optional[CircuitBreaker] = CircuitBreaker(url)
 
     @staticmethod
     def parse_certs(string):
@@ -394,22 +826,90 @@ class Client:
 
         return certs
 
-    def oauth_init(self, client_id: str, secret: str, token_url: str):
-        oauth = OAuth2(client_id, secret, token_url)
+    @staticmethod
+    def parse_poll_hint(headers) -> Optional[float]:
+        """Time in seconds the server asked us to wait before polling again
+
+        Honors `Retry-After`, either in seconds or as HTTP date, and
+        the `max-age` directive of `Cache-Control`.
+        """
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(float(retry_after), 0)
+            except ValueError:
+                pass
+            try:
+                when = email.utils.parsedate_to_datetime(retry_after)
+                return max(when.timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                return None
+
+        cache_control = headers.get("Cache-Control", "")
+        for directive in cache_control.split(","):
+            key, _, value = directive.strip().partition("=")
+            if key.lower() != "max-age":
+                continue
+            try:
+                return max(float(value), 0)
+            except ValueError:
+                return None
+
+        return None
+
+    def oauth_init(self, client_id: str, secret: str, token_url: str, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        oauth = OAuth2(client_id, secret, token_url, **kwargs)
         self.http.auth = oauth
 
     def oauth_check(self, force_new_token: bool = False) -> bool:
         auth = self.http.auth
-        if auth and (auth.token_expired or force_new_token):
-            auth.fetch_token(self.http)
-            return True
+        if not auth:
+            return False
+
+        token = auth.token
+        if not (auth.token_expired or force_new_token):
+            return False
 
-        return False
+        with auth.lock:
+            # The client might be shared between threads, in which
+            # case another thread could have already got a new token
+            if auth.token is token or auth.token_expired:
+                auth.fetch_token(self.http, force=force_new_token)
+
+        return True
+
+    def reset_connections(self):
+        """Drop all pooled connections, e.g. after a fork"""
+        for adapter in self.http.adapters.values():
+            adapter.close()
 
     def request(self, method: str, url: str, js: Optional[Dict] = None):
+        if self.breaker:
+            self.breaker.before_request()
+
+        try:
+            res = self._request(method, url, js)
+        except requests.exceptions.Timeout as e:
+            self.record(False)
+            msg = f"Request to composer timed out: {method} {url}: {e}"
+            raise RequestFailed(msg) from None
+        except requests.exceptions.ConnectionError as e:
+            self.record(False)
+            msg = f"Request to composer failed: {method} {url}: {e}"
+            raise RequestFailed(msg) from None
+
+        self.record(res.status_code < 500)
+        return res
+
+    def record(self, success: bool):
+        if self.breaker:
+            self.breaker.record(success)
+
+    def _request(self, method: str, url: str, js: Optional[Dict] = None):
 
         self.oauth_check()
-        res = self.http.request(method, url, json=js)
+        res = self.http.request(method, url, json=js, timeout=self.timeout)
 
         # If 401 is returned, check if oauth is enabled. If it is, get
         # a new access token and then retry the request.
@@ -418,7 +918,7 @@ class Client:
         # already invalid. This retrying mechanism serves as the last resort
         # attempt to get the request through.
         if res.status_code == 401 and self.oauth_check(True):
-            res = self.http.request(method, url, json=js)
+            res = self.http.request(method, url, json=js, timeout=self.timeout)
 
         return res
 
@@ -452,7 +952,9 @@ class Client:
             msg = f"Failed to get the compose status: {body}"
             raise koji.GenericError(msg) from None
 
-        return ComposeStatus.from_dict(res.json())
+        status = ComposeStatus.from_dict(res.json())
+        status.poll_hint = self.parse_poll_hint(res.headers)
+        return status
 
     def compose_logs(self, compose_id: str):
         url = urllib.parse.urljoin(self.url, f"composes/{compose_id}/logs")
@@ -479,122 +981,1081 @@ class Client:
         js = res.json()
         return js.get("manifests", [])
 
-    def wait_for_compose(self, compose_id: str, *, sleep_time=2, callback=None):
-        while True:
-            status = self.compose_status(compose_id)
-            if callback:
-                callback(status)
+    def health_check(self) -> float:
+        """Check that composer is available, returns the latency"""
+        url = urllib.parse.urljoin(self.url, "openapi")
 
-            if status.is_finished:
-                return status
+        start = time.monotonic()
+        res = self.get(url)
 
-            time.sleep(sleep_time)
+        if res.status_code != 200:
+            msg = f"Composer is unhealthy: {res.status_code}"
+            raise koji.GenericError(msg) from None
 
+        return time.monotonic() - start
 
-class OSBuildImage(BaseTaskHandler):
-    Methods = ['osbuildImage']
-    _taskWeight = 0.2
+    def compose_cancel(self, compose_id: str):
+        url = urllib.parse.urljoin(self.url, f"composes/{compose_id}/cancel")
 
-    def __init__(self, task_id, method, params, session, options):
-        super().__init__(task_id, method, params, session, options)
+        res = self.post(url)
+
+        if res.status_code not in (200, 202, 204):
+            body = res.content.decode("utf-8").strip()
+            msg = f"Failed to cancel the compose: {body}"
+            raise koji.GenericError(msg) from None
 
+    def wait_for_compose(self, compose_id: str, *,  # pylint: disable=too-many-branches
+                         sleep_time=None, callback=None, strategy=None, fail_fast=False,
+                         deadline: Optional[float] = None,
+                         unreachable_max: Optional[float] = None):
+        """Poll the status of the compose until it is finished
+
+        The time between polls is determined by `strategy`, which
+        defaults to `poll_strategy` of the client. For compatibility
+        a fixed `sleep_time` can be given instead.
+        If `fail_fast` is set, return as soon as one image failed, even
+        if the compose itself is not finished yet.
+        If the compose is not finished by `deadline`, as returned by
+        `time.monotonic`, `koji.GenericError` is raised.
+        Requests that failed to connect or timed out are retried, and
+        while the circuit breaker is open, polling is paused. With a
+        `deadline`, only it ends waiting; without one, the last error
+        is raised once composer was unreachable for `unreachable_max`
+        seconds in a row (default: `UNREACHABLE_MAX`).
+        """
+        if strategy is None:
+            if sleep_time is not None:
+                strategy = PollStrategy(sleep_time)
+            else:
+                strategy = self.poll_strategy
+
+        if unreachable_max is None:
+            unreachable_max = self.UNREACHABLE_MAX
+
+        strategy = strategy.clone()
+        last = None
+        unreachable_since = None
+
+        while True:
+            try:
+                status = self.compose_status(compose_id)
+            except CircuitOpen as e:
+                # composer is unavailable, wait until requests are let through again
+                error, delay = e, e.retry_in
+            except RequestFailed as e:
+                # transient network problems, keep trying
+                error, delay = e, strategy.next_delay(False)
+            else:
+                error = None
+                if callback:
+                    callback(status)
+
+                if status.is_finished or (fail_fast and status.has_failed_image):
+                    return status
+
+                current = status.as_dict()
+                changed = last is not None and current != last
+                last = current
+
+                delay = strategy.next_delay(changed, status.poll_hint)
+
+            if error is None:
+                unreachable_since = None
+            elif unreachable_since is None:
+                unreachable_since = time.monotonic()
+            elif deadline is None and time.monotonic() - unreachable_since >= unreachable_max:
+                raise error
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(compose_id)
+                delay = min(delay, remaining)
+
+            time.sleep(delay)
+
+
+class ConfigCache:
+    """Cache for the parsed builder configuration
+
+    The configuration is only parsed again if one of the files changed,
+    i.e. appeared, disappeared or got a new modification time, inode or
+    size. The returned configuration is shared and must not be modified.
+    """
+
+    def __init__(self):
+        self.entries: Dict[Tuple, Tuple[Tuple, configparser.ConfigParser]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def signature(files: List[str]) -> Tuple:
+        res = []
+        for path in files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                res.append(None)
+                continue
+            res.append((st.st_mtime_ns, st.st_ino, st.st_size))
+        return tuple(res)
+
+    @staticmethod
+    def parse(files: List[str]) -> configparser.ConfigParser:
         cfg = configparser.ConfigParser()
         cfg.read_dict({
             "composer": {"server": DEFAULT_COMPOSER_URL},
             "koji": {"server": DEFAULT_KOJIHUB_URL}
         })
 
-        cfg.read(DEFAULT_CONFIG_FILES)
+        cfg.read(files)
+        return cfg
 
-        self.composer_url = cfg["composer"]["server"]
-        self.koji_url = cfg["koji"]["server"]
-        self.client = Client(self.composer_url, 2, 0.05)
-        self.logger = logging.getLogger('koji.plugin.osbuild')
+    def load(self, files: List[str]) -> configparser.ConfigParser:
+        key = tuple(files)
+        signature = self.signature(files)
 
-        self.logger.debug("composer: %s", self.composer_url)
-        self.logger.debug("koji: %s", self.composer_url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == signature:
+                return entry[1]
+
+            cfg = self.parse(files)
+            self.entries[key] = (signature, cfg)
+            return cfg
+
+
+CONFIG = ConfigCache()
+
+
+def read_config(files: Optional[List[str]] = None) -> configparser.ConfigParser:
+    """Read the builder configuration, i.e. `builder.conf`"""
+    return CONFIG.load(files or DEFAULT_CONFIG_FILES)
+
+
+class ClientRegistry:
+    """Process wide registry of composer clients
+
+    Clients, or rather pools of clients, one for each composer, are
+    shared by all users with the same composer configuration, i.e. all
+    `composer` and `composer:*` sections of the config, so that they
+    share the connection pool and the OAuth token. Clients must be
+    safe to use from multiple threads.
+
+    NB: kojid creates the task handlers in its main process and then
+    forks for every task. Pooled connections must never be used by more
+    than one process, so they are dropped in the child after a fork.
+    """
+
+    def __init__(self):
+        self.clients: Dict[Tuple, ComposerPool] = {}
+        self.lock = threading.Lock()
 
-        composer = cfg["composer"]
+    @staticmethod
+    def key_for_config(cfg: configparser.ConfigParser) -> Tuple:
+        sections = [s for s in cfg.sections() if s == "composer" or s.startswith("composer:")]
+        return tuple((s, tuple(sorted(cfg[s].items()))) for s in sorted(sections))
+
+    def get(self, cfg: configparser.ConfigParser, logger: logging.Logger) -> "ComposerPool":
+        key = self.key_for_config(cfg)
+        with self.lock:
+            pool = self.clients.get(key)
+            if pool:
+                logger.debug("Reusing composer clients")
+                return pool
+            pool = make_pool(cfg, logger)
+            self.clients[key] = pool
+            return pool
+
+    def reset_connections(self):
+        for pool in self.clients.values():
+            for client in pool.clients:
+                client.reset_connections()
+
+
+CLIENTS = ClientRegistry()
+os.register_at_fork(after_in_child=CLIENTS.reset_connections)
+
+
+def composer_servers(cfg: configparser.ConfigParser) -> List[str]:
+    """The composer servers of the config, a comma separated list"""
+    return [s.strip() for s in cfg["composer"]["server"].split(",") if s.strip()]
 
-        if "ssl_cert" in composer:
-            data = cfg["composer"]["ssl_cert"]
-            cert = self.client.parse_certs(data)
-            self.client.http.cert = cert
-            self.logger.debug("ssl cert: %s", cert)
 
-        if "ssl_verify" in composer:
+def make_client(cfg: configparser.ConfigParser, logger: logging.Logger,
+                server: Optional[str] = None) -> Client:
+    """Create a composer API client from the builder configuration
+
+    The client is for `server` or, by default, the first composer.
+    """
+    total, backoff_factor, status, jitter = 2, 0.05, None, 0.1
+    if "composer:retries" in cfg:
+        retries = cfg["composer:retries"]
+        total = retries.getint("total", total)
+        backoff_factor = retries.getfloat("backoff_factor", backoff_factor)
+        jitter = retries.getfloat("jitter", jitter)
+        if "status" in retries:
+            status = [int(s) for s in retries["status"].split(",") if s.strip()]
+        logger.debug("Retries: %d, backoff factor: %s, status: %s",
+                     total, backoff_factor, str(status))
+
+    client = Client(server or composer_servers(cfg)[0], total, backoff_factor,
+                    retries_status=status, retries_jitter=jitter)
+
+    composer = cfg["composer"]
+
+    if "ssl_cert" in composer:
+        data = cfg["composer"]["ssl_cert"]
+        cert = client.parse_certs(data)
+        client.http.cert = cert
+        logger.debug("ssl cert: %s", cert)
+
+    if "ssl_verify" in composer:
+        try:
+            val = composer.getboolean("ssl_verify")
+        except ValueError:
+            val = composer["ssl_verify"]
+
+        client.http.verify = val
+        logger.debug("ssl verify: %s", val)
+
+    if "composer:timeouts" in cfg:
+        timeouts = cfg["composer:timeouts"]
+        client.timeout = (timeouts.getfloat("connect", client.timeout[0]),
+                          timeouts.getfloat("read", client.timeout[1]))
+        logger.debug("Timeouts: %s", str(client.timeout))
+
+    if "composer:breaker" in cfg:
+        section = cfg["composer:breaker"]
+        threshold = section.getint("threshold", 5)
+        if threshold > 0:
+            client.breaker = CircuitBreaker(client.server, threshold=threshold,
+                                            reset_timeout=section.getfloat("reset_timeout", 30),
+                                            path=section.get("state"))
+        else:
+            client.breaker = None
+        logger.debug("Circuit breaker: threshold %d", threshold)
+
+    proxy = composer.get("proxy")
+    if proxy:
+        # route both http and https requests through the proxy
+        proxies = {
+            "http": proxy,
+            "https": proxy
+        }
+        client.http.proxies.update(proxies)
+        logger.debug("proxy: %s", proxy)
+
+    if "composer:oauth" in cfg:
+        oa = cfg["composer:oauth"]
+        client_id, client_secret = oa["client_id"], oa["client_secret"]
+        token_url = oa["token_url"]
+        logger.debug("Using OAuth2 with token url: %s", token_url)
+        client.oauth_init(client_id, client_secret, token_url,
+                          cache=oa.get("token_cache"),
+                          refresh_at=oa.getfloat("refresh_at", 0.8))
+
+    if "composer:polling" in cfg:
+        strategy = PollStrategy.from_config(cfg["composer:polling"])
+        logger.debug("Polling strategy: %s", strategy.name)
+        client.poll_strategy = strategy
+
+    return client
+
+
+class ComposerPool:
+    """Clients for one or more composers
+
+    For every new compose, `pick` selects the composer to use: of all
+    composers that pass the health check, the one with the fewest
+    outstanding composes and, among those, the lowest latency is used.
+    Outstanding composes and the average latency are tracked in an
+    optional `SharedState` file at `path`, shared by all tasks on the
+    builder; without it, only the latency of the health check is used.
+    Entries of outstanding composes expire after `max_age` seconds, in
+    case a task did not remove its entry.
+
+    Optionally, `routes` restricts the composers that are used for the
+    images of an architecture ("arch") or of an image type of it
+    ("arch/image_type") to a list of servers, see `route`.
+    """
+
+    def __init__(self, clients: List[Client], path: Optional[str] = None,
+                 max_age: float = 86400,
+                 routes: Optional[Dict[str, List[str]]] = None):
+        self.clients = clients
+        self.path = path
+        self.max_age = max_age
+        self.routes = routes or {}
+
+    def get(self, server: str) -> Optional[Client]:
+        for client in self.clients:
+            if client.server == server:
+                return client
+        return None
+
+    def route(self, ireqs: List[ImageRequest]) -> List[Client]:
+        """The composers that can build all images of `ireqs`
+
+        Since composer imports all images of a compose as a single koji
+        build, a compose can not be split across composers; thus images
+        routed to disjoint sets of composers can not be requested
+        together. Images without a route can use any composer.
+        """
+        servers = None
+        for ireq in ireqs:
+            arch = ireq.architecture
+            shard = self.routes.get(f"{arch}/{ireq.image_type}", self.routes.get(arch))
+            if shard is None:
+                continue
+            servers = set(shard) if servers is None else servers & set(shard)
+
+        if servers is None:
+            return self.clients
+
+        clients = [c for c in self.clients if c.server in servers]
+        if not clients:
+            images = [f"{i.architecture}/{i.image_type}" for i in ireqs]
+            raise koji.BuildError(f"No composer for all of {images}, request them separately")
+        return clients
+
+    def check(self, logger: logging.Logger,
+              clients: Optional[List[Client]] = None) -> Dict[str, float]:
+        """Health check all composers, returns the latency of healthy ones"""
+        latencies = {}
+        for client in clients or self.clients:
             try:
-                val = composer.getboolean("ssl_verify")
-            except ValueError:
-                val = composer["ssl_verify"]
+                latencies[client.server] = client.health_check()
+            except koji.GenericError as e:
+                logger.warning("Composer %s unavailable: %s", client.server, str(e))
+        return latencies
+
+    def load(self, latencies: Dict[str, float]) -> Dict[str, Tuple[int, float]]:
+        """Number of outstanding composes and average latency per composer"""
+        if not self.path:
+            return {server: (0, latency) for server, latency in latencies.items()}
+
+        now = time.time()
+        res = {}
+        with SharedState(self.path) as state:
+            for server, latency in latencies.items():
+                entry = state.data.setdefault(server, {})
+                avg = entry.get("latency")
+                entry["latency"] = latency if avg is None else 0.7 * avg + 0.3 * latency
+                composes = entry.get("composes", {})
+                entry["composes"] = {k: v for k, v in composes.items()
+                                     if now - v <= self.max_age}
+                res[server] = (len(entry["composes"]), entry["latency"])
+            state.save()
+        return res
+
+    def pick(self, logger: logging.Logger,
+             clients: Optional[List[Client]] = None) -> Client:
+        """Select the composer to use for a new compose, from `clients` if given"""
+        clients = clients or self.clients
+        if len(clients) == 1:
+            return clients[0]
+
+        latencies = self.check(logger, clients)
+        if not latencies:
+            raise koji.GenericError("No composer available")
+
+        load = self.load(latencies)
+        server = min(load, key=lambda s: load[s])
+        logger.debug("Composer load: %s, using %s", str(load), server)
+        return self.get(server)
+
+    def begin(self, server: str, compose_id: str):
+        """Record `compose_id` as outstanding compose of `server`"""
+        if not self.path or len(self.clients) == 1:
+            return
+        with SharedState(self.path) as state:
+            entry = state.data.setdefault(server, {})
+            entry.setdefault("composes", {})[compose_id] = time.time()
+            state.save()
+
+    def end(self, server: str, compose_id: str):
+        """Remove the outstanding compose, e.g. since it finished"""
+        if not self.path or len(self.clients) == 1:
+            return
+        with SharedState(self.path) as state:
+            composes = state.data.get(server, {}).get("composes", {})
+            if composes.pop(compose_id, None):
+                state.save()
+
+
+def make_pool(cfg: configparser.ConfigParser, logger: logging.Logger) -> ComposerPool:
+    """Create clients for all composers of the builder configuration"""
+    clients = [make_client(cfg, logger, server) for server in composer_servers(cfg)]
+
+    path, max_age = None, 86400.0
+    if "composer:balancing" in cfg:
+        section = cfg["composer:balancing"]
+        path = section.get("state")
+        max_age = section.getfloat("max_age", max_age)
+
+    routes = {}
+    if "composer:routes" in cfg:
+        for key, value in cfg["composer:routes"].items():
+            routes[key] = [s.strip() for s in value.split(",") if s.strip()]
+            known = [c.server for c in clients]
+            clients += [make_client(cfg, logger, s) for s in routes[key] if s not in known]
+        logger.debug("Composer routes: %s", str(routes))
+
+    return ComposerPool(clients, path, max_age, routes)
+
+
+class StatusMux:
+    """Host-wide multiplexer for compose status requests
+
+    Instead of every `OSBuildImage` task polling composer on its own,
+    with its own connection and OAuth token, a single `StatusMux` per
+    builder host polls all composes that tasks are waiting for. It
+    serves a unix socket that tasks connect to via `StatusMuxClient`.
+
+    The protocol is line based JSON: the client sends a single request
+    `{"compose_id": <id>}`, optionally with the `"composer"` the compose
+    was created on, which must be one of `clients` and defaults to
+    `client`, and then receives one `{"status": <status>}`
+    message, in the format of composer's API, for every change of the
+    compose status. After the compose finished, or if an error occurred,
+    in which case `{"error": <message>}` is sent, the connection is closed.
+    Requests the multiplexer can not serve, i.e. invalid ones or ones for
+    an unknown composer, are answered with an error with `"rejected": true`,
+    upon which the task polls composer itself.
+
+    Every compose is polled according to its own copy of the polling
+    strategy of the client and only as long as there are tasks waiting
+    for it.
+    """
+
+    class Watch:
+        def __init__(self, client: Client, strategy: PollStrategy):
+            self.client = client
+            self.strategy = strategy
+            self.subscribers: List[queue.Queue] = []
+            self.next_poll = 0.0
+            self.last: Optional[Dict] = None
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            mux = self.server.mux  # type: ignore
+
+            line = self.rfile.readline()
+            if not line:
+                return  # no request, e.g. checked by another multiplexer
+
+            try:
+                req = json.loads(line)
+                compose_id = str(req["compose_id"])
+                composer = req.get("composer") or mux.client.server
+            except (ValueError, KeyError, TypeError):
+                self.send({"error": "Invalid request", "rejected": True})
+                return
+
+            client = mux.clients.get(composer)
+            if not client:
+                # e.g. the multiplexer runs with an older configuration
+                mux.logger.warning("Request for unknown composer %s", composer)
+                self.send({"error": f"Unknown composer {composer}", "rejected": True})
+                return
+
+            q = mux.subscribe(compose_id, client)
+            try:
+                while True:
+                    msg = q.get()
+                    self.send(msg)
+                    if "error" in msg or msg.get("finished"):
+                        break
+            except OSError:
+                pass  # the task went away
+            finally:
+                mux.unsubscribe(compose_id, q)
+
+        def send(self, msg: Dict):
+            self.wfile.write(json.dumps(msg).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+    def __init__(self, client: Client, path: str, logger: Optional[logging.Logger] = None, *,
+                 clients: Optional[List[Client]] = None):
+        self.client = client
+        self.clients = {c.server: c for c in (clients or [client])}
+        self.path = path
+        self.logger = logger or logging.getLogger('koji.plugin.osbuild')
+        self.watches: Dict[str, StatusMux.Watch] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.server: Optional[socketserver.ThreadingUnixStreamServer] = None
+
+    def subscribe(self, compose_id: str, client: Optional[Client] = None) -> queue.Queue:
+        client = client or self.client
+        q: queue.Queue = queue.Queue()
+        with self.lock:
+            watch = self.watches.get(compose_id)
+            if not watch:
+                watch = self.Watch(client, client.poll_strategy.clone())
+                self.watches[compose_id] = watch
+            elif watch.last:
+                q.put(watch.last)
+            watch.subscribers.append(q)
+        self.logger.debug("Watching compose %s", compose_id)
+        self.wakeup.set()
+        return q
+
+    def unsubscribe(self, compose_id: str, q: queue.Queue):
+        with self.lock:
+            watch = self.watches.get(compose_id)
+            if not watch:
+                return
+            if q in watch.subscribers:
+                watch.subscribers.remove(q)
+            if not watch.subscribers:
+                del self.watches[compose_id]
+
+    def publish(self, compose_id: str, msg: Dict, done: bool):
+        with self.lock:
+            watch = self.watches.get(compose_id)
+            if not watch:
+                return
+            watch.last = msg
+            for q in watch.subscribers:
+                q.put(msg)
+            if done:
+                del self.watches[compose_id]
+
+    def poll(self, compose_id: str, watch: "StatusMux.Watch"):
+        try:
+            status = watch.client.compose_status(compose_id)
+        except CircuitOpen as e:
+            # composer is unavailable, poll again once requests are let through
+            watch.next_poll = time.monotonic() + watch.strategy.next_delay(False, e.retry_in)
+            return
+        except (RequestFailed, requests.exceptions.RequestException) as e:
+            # transient network problems, keep trying
+            self.logger.warning("Failed to poll compose %s: %s", compose_id, str(e))
+            watch.next_poll = time.monotonic() + watch.strategy.next_delay(False)
+            return
+        except koji.GenericError as e:
+            self.publish(compose_id, {"error": str(e)}, True)
+            return
+
+        msg = {
+            "status": status.as_api_dict(),
+            "finished": status.is_finished
+        }
+
+        changed = watch.last is not None and watch.last != msg
+        if watch.last != msg:
+            self.publish(compose_id, msg, status.is_finished)
+
+        delay = watch.strategy.next_delay(changed, status.poll_hint)
+        watch.next_poll = time.monotonic() + delay
+
+    def run(self):
+        """Poll all watched composes until `stop` is called"""
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            with self.lock:
+                due = [(k, w) for k, w in self.watches.items() if w.next_poll <= now]
+
+            for compose_id, watch in due:
+                self.poll(compose_id, watch)
+
+            with self.lock:
+                times = [w.next_poll for w in self.watches.values()]
+
+            timeout = max(min(times) - time.monotonic(), 0) if times else None
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    @staticmethod
+    def is_serving(path: str) -> bool:
+        """Check if a multiplexer is accepting connections on `path`"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def serve(self):
+        """Serve the unix socket and poll composer until stopped
+
+        The socket is only accessible by the current user, which must be
+        the one kojid runs as, since the multiplexer polls composer with
+        its credentials. A stale socket is replaced, but if another
+        multiplexer is serving it, `koji.GenericError` is raised.
+        """
+        if os.path.exists(self.path):
+            if self.is_serving(self.path):
+                raise koji.GenericError(f"Status multiplexer already running on {self.path}")
+            os.unlink(self.path)
+
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, self.RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        self.server.mux = self  # type: ignore
+
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.logger.info("Status multiplexer listening on %s", self.path)
 
-            self.client.http.verify = val
-            self.logger.debug("ssl verify: %s", val)
+        try:
+            self.run()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            os.unlink(self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+class StatusMuxRejected(Exception):
+    """The status multiplexer can not serve the request"""
+
+
+class StatusMuxClient:
+    """Wait for composes via the host-wide `StatusMux`"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def wait_for_compose(self, compose_id: str, *, callback=None, fail_fast=False,
+                         deadline: Optional[float] = None,
+                         composer: Optional[str] = None) -> ComposeStatus:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            req = {"compose_id": compose_id}
+            if composer:
+                req["composer"] = composer
+
+            sock.connect(self.path)
+            sock.sendall(json.dumps(req).encode("utf-8") + b"\n")
+
+            for line in self.readlines(sock, compose_id, deadline):
+                msg = json.loads(line)
+                if msg.get("rejected"):
+                    raise StatusMuxRejected(msg.get("error"))
+                if "error" in msg:
+                    raise koji.GenericError(msg["error"])
+
+                status = ComposeStatus.from_dict(msg["status"])
+                if callback:
+                    callback(status)
+
+                if status.is_finished or (fail_fast and status.has_failed_image):
+                    return status
+        finally:
+            sock.close()
+
+        raise ConnectionError("Status multiplexer closed the connection")
+
+    @staticmethod
+    def readlines(sock: socket.socket, compose_id: str, deadline: Optional[float]):
+        """Read lines until the connection is closed or the `deadline`"""
+        f = sock.makefile("rb")
+        while True:
+            if deadline is not None:
+                # NB: the timeout applies to every read, not in total
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(compose_id)
+                sock.settimeout(remaining)
+
+            try:
+                line = f.readline()
+            except socket.timeout:
+                raise DeadlineExceeded(compose_id) from None
+
+            if not line:
+                return
+            yield line
+
+
+class HubCache:
+    """Cache of hub lookups shared by all tasks on the builder
+
+    Build targets are cached by their name and the build configs of
+    build tags by the tag id, each for `ttl` seconds. Repos are not
+    cached, since the hub can regenerate them at any time; instead, the
+    id of the repo that was current when the build config was fetched is
+    recorded with it. If a different repo is seen for the tag, all of its
+    cached data, including the targets using it, needs to be dropped via
+    `invalidate`, see `OSBuildImage.lookup_build_tag`.
+    The cache is stored in a `SharedState` file at `path`.
+    """
+
+    def __init__(self, path: str, ttl: float = 60):
+        self.path = path
+        self.ttl = ttl
+
+    def _get(self, key: str) -> Optional[Dict]:
+        with SharedState(self.path) as state:
+            entry = state.data.get(key)
+        if not entry or time.time() - entry.get("time", 0) > self.ttl:
+            return None
+        return entry
+
+    def _put(self, key: str, entry: Dict):
+        now = time.time()
+        with SharedState(self.path) as state:
+            data = {k: v for k, v in state.data.items() if now - v.get("time", 0) <= self.ttl}
+            entry["time"] = now
+            data[key] = entry
+            state.data = data
+            state.save()
+
+    def get_target(self, name: str) -> Optional[Dict]:
+        entry = self._get(f"target:{name}")
+        return entry and entry["info"]
+
+    def put_target(self, name: str, info: Dict):
+        self._put(f"target:{name}", {"info": info, "build_tag": str(info["build_tag"])})
+
+    def get_build_tag(self, tag) -> Optional[Tuple[Dict, Optional[int]]]:
+        """The build config of `tag` and the id of the repo it was fetched with"""
+        entry = self._get(f"tag:{tag}")
+        return entry and (entry["config"], entry.get("repo_id"))
+
+    def put_build_tag(self, tag, config: Dict, repo_id: Optional[int]):
+        self._put(f"tag:{tag}", {"config": config, "repo_id": repo_id})
+
+    def put_repo(self, tag, repo_id: int):
+        """Record the repo of `tag` that appeared after the build config was fetched"""
+        key = f"tag:{tag}"
+        entry = self._get(key)
+        if not entry or entry.get("repo_id") is not None:
+            return
+        entry["repo_id"] = repo_id
+        self._put(key, entry)
+
+    def invalidate(self, tag):
+        """Drop all cached data of `tag`, including the targets using it"""
+        with SharedState(self.path) as state:
+            state.data = {k: v for k, v in state.data.items()
+                          if k != f"tag:{tag}" and v.get("build_tag") != str(tag)}
+            state.save()
 
-        proxy = composer.get("proxy")
-        if proxy:
-            # route both http and https requests through the proxy
-            proxies = {
-                "http": proxy,
-                "https": proxy
+
+class ComposeIndex:
+    """Index of successful composes, by the digest of their request
+
+    Shared by all tasks on the builder, stored in a `SharedState` file
+    at `path`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def get(self, digest: str) -> Optional[Dict]:
+        with SharedState(self.path) as state:
+            return state.data.get(digest)
+
+    def add(self, digest: str, compose_id: str, build_id: int):
+        with SharedState(self.path) as state:
+            state.data[digest] = {
+                "compose_id": compose_id,
+                "build_id": build_id,
+                "time": time.time(),
             }
-            self.client.http.proxies.update(proxies)
-            self.logger.debug("proxy: %s", proxy)
+            state.save()
+
+    def remove(self, digest: str):
+        with SharedState(self.path) as state:
+            if state.data.pop(digest, None):
+                state.save()
+
+
+class TokenBucket:
+    """Host-wide rate limit, shared by all tasks on the builder
+
+    Up to `burst` tokens are available, replenished at `rate` tokens per
+    second. Each `acquire` takes one token, waiting until one becomes
+    available. The state of the bucket is stored in a `SharedState` file
+    at `path`.
+    """
+
+    def __init__(self, path: str, rate: float, burst: float = 1):
+        if rate <= 0:
+            raise ValueError(f"Invalid rate: {rate}")
+        self.path = path
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+    def take(self) -> float:
+        """Take a token, if available
+
+        Returns 0 if a token was taken, otherwise the time in seconds
+        until the next token becomes available.
+        """
+        now = time.time()
+        with SharedState(self.path) as state:
+            tokens = state.data.get("tokens", self.burst)
+            last = state.data.get("time", now)
+            tokens = min(self.burst, tokens + max(now - last, 0) * self.rate)
+
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+
+            state.data = {"tokens": tokens, "time": now}
+            state.save()
+
+        return wait
+
+    def acquire(self, *, deadline: Optional[float] = None) -> float:
+        """Wait for and take a token, returns the time waited
+
+        If no token could be taken before `deadline`, as returned by
+        `time.monotonic`, `koji.GenericError` is raised.
+        """
+        start = time.monotonic()
+        while True:
+            wait = self.take()
+            if not wait:
+                return time.monotonic() - start
 
-        if "composer:oauth" in cfg:
-            oa = cfg["composer:oauth"]
-            client_id, client_secret = oa["client_id"], oa["client_secret"]
-            token_url = oa["token_url"]
-            self.logger.debug("Using OAuth2 with token url: %s", token_url)
-            self.client.oauth_init(client_id, client_secret, token_url)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise koji.GenericError("Not admitted to create a compose in time")
+                wait = min(wait, remaining)
 
-    def upload_json(self, data: Dict, name: str):
+            # NB: other tasks wait as well, add jitter to avoid that
+            # they all check at the same time
+            time.sleep(wait * random.uniform(1, 1.2))
+
+
+class OSBuildImage(BaseTaskHandler):  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    Methods = ['osbuildImage']
+    _taskWeight = 0.2
+
+    UPLOAD_WORKERS = 4
+
+    def __init__(self, task_id, method, params, session, options):
+        super().__init__(task_id, method, params, session, options)
+
+        cfg = read_config()
+
+        self.koji_url = cfg["koji"]["server"]
+        self.logger = logging.getLogger('koji.plugin.osbuild')
+
+        # the composer to use is picked for every compose, see
+        # `start_compose`, until then it is the first one
+        self.composers = CLIENTS.get(cfg, self.logger)
+        self.client = self.composers.clients[0]
+
+        self.logger.debug("composer: %s", self.composer_url)
+        self.logger.debug("koji: %s", self.koji_url)
+
+        # number of threads used to upload the logs and manifests
+        self.upload_workers = cfg["koji"].getint("upload_workers", self.UPLOAD_WORKERS)
+
+        # maximal run time of the task, see `deadline`
+        self.max_duration = None
+        if "composer:timeouts" in cfg:
+            self.max_duration = cfg["composer:timeouts"].getfloat("deadline") or None
+        self.deadline: Optional[float] = None
+
+        self.admission = None
+        if "composer:admission" in cfg:
+            section = cfg["composer:admission"]
+            self.admission = TokenBucket(section["state"],
+                                         section.getfloat("rate"),
+                                         section.getfloat("burst", 1))
+            self.logger.debug("admission control: %s per second, burst: %s",
+                              self.admission.rate, self.admission.burst)
+
+        self.hub_cache = None
+        if "cache" in cfg["koji"]:
+            ttl = cfg["koji"].getfloat("cache_ttl", 60)
+            self.hub_cache = HubCache(cfg["koji"]["cache"], ttl)
+            self.logger.debug("hub cache: %s (ttl: %s)", self.hub_cache.path, ttl)
+
+        self.compose_index = None
+        if "compose_index" in cfg["koji"]:
+            self.compose_index = ComposeIndex(cfg["koji"]["compose_index"])
+            self.logger.debug("compose index: %s", self.compose_index.path)
+
+        self.mux_socket = None
+        if "composer:mux" in cfg:
+            self.mux_socket = cfg["composer:mux"].get("socket")
+            self.logger.debug("status multiplexer: %s", self.mux_socket)
+
+        # digest of the last uploaded compose status
+        self.status_digest: Optional[str] = None
+        # buffers of the append-only (ndjson) task outputs
+        self.ndjson: Dict[str, io.StringIO] = {}
+        # names of the images, in the order of the image requests
+        self.image_names: List[str] = []
+        # last seen status and its start time for the compose and images
+        self.phases: Dict[str, Tuple[str, float]] = {}
+        # accumulated time spent in each phase: name -> status -> seconds
+        self.phase_durations: Dict[str, Dict[str, float]] = {}
+
+    @property
+    def composer_url(self) -> str:
+        return self.client.server
+
+    def upload_json(self, data: Dict, name: str, *, session=None):
         fd = io.StringIO()
         json.dump(data, fd, indent=4, sort_keys=True)
         fd.seek(0)
         path = koji.pathinfo.taskrelpath(self.id)
-        fast_incremental_upload(self.session,
+        fast_incremental_upload(session or self.session,
                                 name + ".json",
                                 fd,
                                 path,
                                 3,  # retries
                                 self.logger)
 
-    def attach_logs(self, compose_id: str, ireqs: List[ImageRequest]):
+    def append_ndjson(self, data: Dict, name: str):
+        """Append `data` as a line to the task output `name`.ndjson
+
+        Only the new line is uploaded, at the offset of the end of
+        the previously uploaded content.
+        """
+        fd = self.ndjson.setdefault(name, io.StringIO())
+        offset = fd.seek(0, io.SEEK_END)
+        # NB: ensure_ascii, so that string offsets are byte offsets
+        fd.write(json.dumps(data, sort_keys=True, ensure_ascii=True) + "\n")
+        fd.seek(offset)
+        path = koji.pathinfo.taskrelpath(self.id)
+        fast_incremental_upload(self.session,
+                                name + ".ndjson",
+                                fd,
+                                path,
+                                3,  # retries
+                                self.logger)
+
+    def restore_ndjson(self, name: str) -> List[Dict]:
+        """Continue the task output `name`.ndjson of a previous run
+
+        The content uploaded by the previous run is loaded, so that new
+        lines are appended to it, see `append_ndjson`. Returns the
+        entries of the previous run.
+        """
+        try:
+            data = self.session.downloadTaskOutput(self.id, name + ".ndjson")
+        except koji.GenericError:
+            return []
+
+        text = data.decode("utf-8")
+        fd = io.StringIO()
+        fd.write(text)
+        self.ndjson[name] = fd
+
+        entries = []
+        for line in text.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                self.logger.warning("Invalid line in %s.ndjson: %s", name, line)
+        return entries
+
+    def fetch_logs(self, compose_id: str, ireqs: List[ImageRequest]) -> List[Tuple[Dict, str]]:
         self.logger.debug("Fetching logs")
 
         try:
             logs = self.client.compose_logs(compose_id)
         except koji.GenericError as e:
             self.logger.warning("Failed to fetch logs: %s", str(e))
-            return
+            return []
+
+        outputs = []
 
         if logs.koji_init_logs:
-            self.upload_json(logs.koji_init_logs, "koji-init.log")
+            outputs.append((logs.koji_init_logs, "koji-init.log"))
 
         if logs.koji_import_logs:
-            self.upload_json(logs.koji_import_logs, "koji-import.log")
+            outputs.append((logs.koji_import_logs, "koji-import.log"))
 
         ilogs = zip(logs.image_logs, ireqs)
         for log, ireq in ilogs:
             name = f"{ireq.architecture}-{ireq.image_type}.log"
-            self.logger.debug("Uploading logs: %s", name)
-            self.upload_json(log, name)
+            outputs.append((log, name))
+
+        return outputs
 
-    def attach_manifests(self, compose_id: str, ireqs: List[ImageRequest]):
+    def fetch_manifests(self, compose_id: str, ireqs: List[ImageRequest]) -> List[Tuple[Dict, str]]:
         self.logger.debug("Fetching manifests")
 
         try:
             manifests = self.client.compose_manifests(compose_id)
         except koji.GenericError as e:
             self.logger.warning("Failed to fetch manifests: %s", str(e))
-            return
+            return []
 
         imanifests = zip(manifests, ireqs)
-        for manifest, ireq in imanifests:
-            name = f"{ireq.architecture}-{ireq.image_type}.manifest"
-            self.logger.debug("Uploading manifest: %s", name)
-            self.upload_json(manifest, name)
+        return [
+            (manifest, f"{ireq.architecture}-{ireq.image_type}.manifest")
+            for manifest, ireq in imanifests
+        ]
+
+    def upload_outputs(self, outputs: List[Tuple[Dict, str]]):
+        """Upload all `outputs`, i.e. (data, name) pairs, as json
+
+        Uploads are done concurrently by up to `upload_workers` threads.
+        Since a koji session must not be used by multiple threads at the
+        same time, each upload uses one of the subsessions that are
+        created up front, in the calling thread, one per worker.
+        """
+        workers = min(self.upload_workers, len(outputs))
+        if workers <= 1:
+            for data, name in outputs:
+                self.logger.debug("Uploading: %s", name)
+                self.upload_json(data, name)
+            return
+
+        sessions: List = []
+        idle: queue.Queue = queue.Queue()
+
+        def upload(data, name):
+            session = idle.get()
+            try:
+                self.logger.debug("Uploading: %s", name)
+                self.upload_json(data, name, session=session)
+            finally:
+                idle.put(session)
+
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+        try:
+            for _ in range(workers):
+                session = self.session.subsession()
+                sessions.append(session)
+                idle.put(session)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(upload, data, name) for data, name in outputs]
+                for f in futures:
+                    f.result()
+        finally:
+            for session in sessions:
+                try:
+                    session.logout()
+                except koji.GenericError as e:
+                    self.logger.warning("Failed to log out subsession: %s", str(e))
+
+    def attach_results(self, compose_id: str, ireqs: List[ImageRequest]):
+        """Fetch the manifests and logs of the compose and upload them"""
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            manifests = pool.submit(self.fetch_manifests, compose_id, ireqs)
+            logs = pool.submit(self.fetch_logs, compose_id, ireqs)
+            outputs = manifests.result() + logs.result()
+
+        self.upload_outputs(outputs)
 
     @staticmethod
     def arches_for_config(buildconfig: Dict):
@@ -604,8 +2065,11 @@ class OSBuildImage(BaseTaskHandler):
             raise koji.BuildError(f"Missing arches for tag '%{name}'")
         return set(koji.canonArch(a) for a in archstr.split())
 
-    def make_repos_for_target(self, target_info):
-        repo_info = self.getRepo(target_info['build_tag'])
+    def make_repos_for_target(self, target_info, repo_info=None):
+        if not repo_info:
+            repo_info = self.getRepo(target_info['build_tag'])
+            if repo_info and self.hub_cache:
+                self.hub_cache.put_repo(target_info['build_tag'], repo_info['id'])
         if not repo_info:
             return None
         self.logger.debug("repo info: %s", str(repo_info))
@@ -618,6 +2082,262 @@ class OSBuildImage(BaseTaskHandler):
         self.logger.debug("user repo override: %s", str(repos))
         return [Repository.from_data(r) for r in repos]
 
+    def lookup_target(self, target: str, nvr: NVR) -> dict:
+        """Fetch the build target and, if needed, the next release
+
+        Both calls are independent of each other and thus are done
+        in a single round-trip to the hub via a multicall. The target
+        is taken from the hub cache, if enabled and present.
+        """
+        start = time.monotonic()
+
+        target_info = self.hub_cache and self.hub_cache.get_target(target)
+        if target_info:
+            self.logger.debug("Target '%s' found in the hub cache", target)
+
+        if target_info and nvr.release:
+            return target_info
+
+        with self.session.multicall(strict=True) as m:
+            target_call = None
+            if not target_info:
+                target_call = m.getBuildTarget(target, strict=True)
+            release_call = None
+            if not nvr.release:
+                release_call = m.getNextRelease(nvr.as_dict())
+
+        if target_call:
+            target_info = target_call.result
+            if target_info and self.hub_cache:
+                self.hub_cache.put_target(target, target_info)
+        if release_call:
+            nvr.release = release_call.result
+
+        self.logger.info("Hub lookup of target and release: %.3fs",
+                         time.monotonic() - start)
+        return target_info
+
+    def lookup_build_tag(self, build_tag, *, with_repo: bool) -> Tuple[dict, Optional[dict]]:
+        """Fetch the build config and, if requested, the repo of `build_tag`
+
+        Both are fetched in a single round-trip to the hub via a
+        multicall. If the hub has no repo for the tag, the result for
+        the repo is `None` and `getRepo` needs to be used to wait for
+        one. If the hub cache is enabled, the build config is taken from
+        it, as long as the repo of the tag did not change since it was
+        fetched; the repo itself is always fetched from the hub.
+        """
+        start = time.monotonic()
+
+        cached = self.hub_cache and self.hub_cache.get_build_tag(build_tag)
+        if cached and not with_repo:
+            self.logger.debug("Build tag '%s' found in the hub cache", build_tag)
+            return cached[0], None
+
+        with self.session.multicall(strict=True) as m:
+            config_call = None if cached else m.getBuildConfig(build_tag)
+            repo_call = m.getRepo(build_tag) if with_repo else None
+
+        repo_info = repo_call.result if repo_call else None
+        repo_id = repo_info["id"] if repo_info else None
+
+        if cached and cached[1] == repo_id:
+            self.logger.debug("Build tag '%s' found in the hub cache", build_tag)
+            return cached[0], repo_info
+
+        if cached:
+            # a new repo was generated for the tag, which may have changed
+            self.logger.debug("New repo for build tag '%s', dropping cached data", build_tag)
+            self.hub_cache.invalidate(build_tag)
+            buildconfig = self.session.getBuildConfig(build_tag)
+        else:
+            buildconfig = config_call.result
+
+        if self.hub_cache:
+            self.hub_cache.put_build_tag(build_tag, buildconfig, repo_id)
+
+        self.logger.info("Hub lookup of build config and repo: %.3fs",
+                         time.monotonic() - start)
+        return buildconfig, repo_info
+
+    def save_compose_id(self, compose_id: str):
+        """Record the id of the compose as task output
+
+        Used to re-attach to the compose if the task is run again, e.g.
+        after a restart of kojid, see `load_compose_id`.
+        """
+        data = {
+            "composer": self.composer_url,
+            "compose_id": compose_id,
+        }
+        self.upload_json(data, "compose-id")
+
+    def load_compose_id(self) -> Optional[str]:
+        """Return the id of the compose created by a previous run
+
+        The compose id is read from the output of this task, recorded
+        by `save_compose_id`, and only returned if composer still knows
+        the compose and it belongs to this task.
+        """
+        try:
+            data = json.loads(self.session.downloadTaskOutput(self.id, "compose-id.json"))
+            compose_id = data["compose_id"]
+            composer = data["composer"]
+        except (koji.GenericError, ValueError, TypeError, KeyError):
+            return None
+
+        client = self.composers.get(composer)
+        if not client:
+            self.logger.info("Not resuming compose %s of unknown composer %s",
+                             compose_id, composer)
+            return None
+
+        try:
+            status = client.compose_status(compose_id)
+        except koji.GenericError as e:
+            self.logger.warning("Could not resume compose %s: %s", compose_id, str(e))
+            return None
+
+        if status.koji_task_id not in (None, self.id):
+            self.logger.warning("Not resuming compose %s of task %s",
+                                compose_id, status.koji_task_id)
+            return None
+
+        # stick to the composer of the compose
+        self.client = client
+        return compose_id
+
+    def find_compose(self, digest: str) -> Optional[Tuple[str, int]]:
+        """Find a successful compose with the same request `digest`
+
+        Returns the compose and build id, if the index has an entry
+        and the build still exists and is complete.
+        """
+        entry = self.compose_index.get(digest)
+        if not entry:
+            return None
+
+        build = self.session.getBuild(entry["build_id"])
+        if not build or build["state"] != koji.BUILD_STATES["COMPLETE"]:
+            self.logger.info("Build %s of compose %s is gone, not reusing it",
+                             entry["build_id"], entry["compose_id"])
+            self.compose_index.remove(digest)
+            return None
+
+        self.upload_json({"digest": digest, **entry}, "compose-reuse")
+        return entry["compose_id"], entry["build_id"]
+
+    def make_compose(self, request: ComposeRequest, ireqs: List[ImageRequest], *,
+                     reusable: bool, with_release: bool = False,
+                     fail_fast=False) -> Tuple[str, int, bool]:
+        """Reuse an identical successful compose or run a new one
+
+        Composes are only reused if the compose index is enabled and
+        the request is `reusable`. The release is only part of the
+        comparison `with_release`, i.e. if it was explicitly requested
+        instead of being the next one. Returns the compose and build id
+        and whether they were reused.
+        """
+        digest = None
+        if self.compose_index and reusable:
+            digest = request.digest(with_release=with_release)
+            self.logger.debug("Compose request digest: %s", digest)
+
+        reused = digest and self.find_compose(digest)
+        if reused:
+            self.logger.info("Reusing compose %s (build %s)", *reused)
+            return (*reused, True)
+
+        cid, bid = self.run_compose(request, ireqs, fail_fast=fail_fast)
+        if digest:
+            self.compose_index.add(digest, cid, bid)
+        return cid, bid, False
+
+    def cancel_compose(self, cid: str, error: Optional[BaseException] = None):
+        """Cancel the compose, e.g. after waiting for it failed with `error`
+
+        If the task process was interrupted, e.g. by a signal, but the
+        task is still open, kojid is shutting down and the compose is
+        kept to be resumed when the task is run again. Otherwise, i.e.
+        the task was canceled or is going to fail, it is canceled.
+        """
+        if error is not None and not isinstance(error, Exception):
+            try:
+                info = self.session.getTaskInfo(self.id)
+            except koji.GenericError:
+                info = None
+
+            if info and info["state"] == koji.TASK_STATES["OPEN"]:
+                self.logger.info("Task interrupted, keeping compose %s", cid)
+                return
+
+        self.logger.info("Canceling compose %s", cid)
+        try:
+            self.client.compose_cancel(cid)
+        except (koji.GenericError, requests.exceptions.RequestException) as e:
+            self.logger.warning("Failed to cancel compose %s: %s", cid, str(e))
+
+    def run_compose(self, request: ComposeRequest, ireqs: List[ImageRequest], *,
+                    fail_fast=False) -> Tuple[str, int]:
+        """Create (or resume) the compose and wait for it to finish
+
+        With `fail_fast`, the compose is canceled as soon as one of its
+        images failed. Returns the compose and koji build id of the
+        successful compose.
+        """
+        cid = self.start_compose(request)
+        self.composers.begin(self.composer_url, cid)
+
+        self.logger.debug("Waiting for compose to finish")
+        try:
+            status = self.wait_for_compose(cid, fail_fast=fail_fast)
+        except BaseException as e:
+            self.cancel_compose(cid, e)
+            raise
+        finally:
+            self.composers.end(self.composer_url, cid)
+
+        if not status.is_finished:
+            self.logger.info("Image failed, failing fast")
+            self.cancel_compose(cid)
+
+        self.logger.debug("Compose finished: %s", str(status.as_dict()))
+        self.logger.info("Compose result: %s", status.status)
+
+        for image, durations in self.phase_durations.items():
+            phases = ", ".join(f"{k}: {v:.1f}s" for k, v in durations.items())
+            self.logger.info("Phase durations of %s: %s", image, phases)
+
+        self.attach_results(cid, ireqs)
+
+        if not status.is_success:
+            raise koji.BuildError(f"Compose failed (id: {cid})")
+
+        # Successful compose, must have a build id associated
+        return cid, status.koji_build_id
+
+    def start_compose(self, request: ComposeRequest) -> str:
+        """Create the compose, or resume the one of a previous run"""
+        cid = self.load_compose_id()
+        if cid:
+            self.logger.info("Resuming compose: %s", cid)
+            self.restore_ndjson("compose-status-history")
+            for entry in self.restore_ndjson("compose-timeline"):
+                self.phases[entry["name"]] = (entry["status"], entry["time"])
+            return cid
+
+        if self.admission:
+            self.set_phase("compose", "queued", time.time())
+            waited = self.admission.acquire(deadline=self.deadline)
+            self.logger.info("Admitted to create the compose after %.1fs", waited)
+
+        shard = self.composers.route(request.image_requests)
+        self.client = self.composers.pick(self.logger, shard)
+        cid = self.client.compose_create(request)
+        self.logger.info("Compose id: %s (composer: %s)", cid, self.composer_url)
+        self.save_compose_id(cid)
+        return cid
+
     def map_koji_api_image_type(self, image_type: str) -> str:
         mapped = KOJIAPI_IMAGE_TYPES.get(image_type)
         if not mapped:
@@ -627,7 +2347,14 @@ class OSBuildImage(BaseTaskHandler):
                           image_type, mapped)
         return mapped
 
-    def tag_build(self, tag, build_id):
+    def tag_build(self, tag, build_id, *, unless_tagged=False):
+        """Tag the build, if `unless_tagged` only if it is not yet"""
+        if unless_tagged:
+            tags = self.session.listTags(build=build_id)
+            if any(t["id"] == tag for t in tags):
+                self.logger.info("Build %s already tagged with %s", build_id, tag)
+                return
+
         args = [
             tag,       # tag id
             build_id,  # build id
@@ -644,22 +2371,116 @@ class OSBuildImage(BaseTaskHandler):
         self.wait(task)
 
     def on_status_update(self, status: ComposeStatus):
-        self.upload_json(status.as_dict(), "compose-status")
+        data = status.as_dict()
+
+        # Only upload the status if it changed since the last poll
+        canonical = json.dumps(data, sort_keys=True).encode("utf-8")
+        digest = hashlib.sha256(canonical).hexdigest()
+        if digest == self.status_digest:
+            return
+        self.status_digest = digest
+
+        self.upload_json(data, "compose-status")
+
+        entry = {
+            "time": time.time(),
+            "status": data
+        }
+        self.append_ndjson(entry, "compose-status-history")
+
+        self.update_timeline(status)
+
+    def update_timeline(self, status: ComposeStatus):
+        """Record status transitions of the compose and its images
+
+        Every transition is appended to `compose-timeline.ndjson`,
+        together with the time spent in the previous status.
+        """
+        now = time.time()
+
+        current = {"compose": status.status}
+        for i, image in enumerate(status.images):
+            name = self.image_names[i] if i < len(self.image_names) else f"image-{i}"
+            current[name] = image.status
+
+        for name, phase in current.items():
+            self.set_phase(name, phase, now)
+
+    def set_phase(self, name: str, phase: str, now: float):
+        """Record the transition of `name` into `phase` at `now`"""
+        previous, since = self.phases.get(name, (None, now))
+        if phase == previous:
+            return
+
+        entry = {
+            "time": now,
+            "name": name,
+            "status": phase,
+            "previous": previous,
+        }
+
+        if previous is not None:
+            duration = now - since
+            entry["duration"] = duration
+            durations = self.phase_durations.setdefault(name, {})
+            durations[previous] = durations.get(previous, 0) + duration
+
+        self.phases[name] = (phase, now)
+        self.append_ndjson(entry, "compose-timeline")
+
+    def wait_for_compose(self, cid: str, *, fail_fast=False) -> ComposeStatus:
+        """Wait for the compose, preferably via the status multiplexer
+
+        With `fail_fast`, stop waiting as soon as one image failed.
+        Waiting fails with `DeadlineExceeded` at the task's `deadline`.
+        """
+        if self.mux_socket:
+            mux = StatusMuxClient(self.mux_socket)
+            try:
+                return mux.wait_for_compose(cid, callback=self.on_status_update,
+                                            fail_fast=fail_fast, deadline=self.deadline,
+                                            composer=self.composer_url)
+            except (OSError, ValueError, StatusMuxRejected) as e:
+                self.logger.warning("Status multiplexer unavailable, polling directly: %s", str(e))
+
+        return self.client.wait_for_compose(cid, callback=self.on_status_update,
+                                            fail_fast=fail_fast, deadline=self.deadline)
+
+    @staticmethod
+    def on_sigterm(signum, _frame):
+        raise SystemExit(f"Terminated by signal {signum}")
 
     # pylint: disable=arguments-differ
     def handler(self, name, version, distro, image_type, target, arches, opts):
         """Main entry point for the task"""
+        # kojid terminates the task process, e.g. when the task got
+        # canceled; make sure that this raises an exception, so that
+        # the compose can be canceled, see `cancel_compose`.
+        # NB: the handler is created in kojid's main process, long
+        # before the task is run, so the deadline is set here
+        if self.max_duration:
+            self.deadline = time.monotonic() + self.max_duration
+
+        main_thread = threading.current_thread() is threading.main_thread()
+        if main_thread and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, self.on_sigterm)
+
         self.logger.debug("Building image via osbuild %s, %s, %s, %s",
                           name, str(arches), str(target), str(opts))
 
         self.logger.info("Task id: %s", str(self.id))
 
-        target_info = self.session.getBuildTarget(target, strict=True)
+        # Version and names
+        nvr = NVR(name, version, opts.get("release"))
+
+        target_info = self.lookup_target(target, nvr)
         if not target_info:
             raise koji.BuildError(f"Target '{target}' not found")
 
+        repo_urls = opts.get("repo")
+
         build_tag = target_info['build_tag']
-        buildconfig = self.session.getBuildConfig(build_tag)
+        buildconfig, repo_info = self.lookup_build_tag(build_tag, with_repo=not repo_urls)
 
         # Architectures
         tag_arches = self.arches_for_config(buildconfig)
@@ -668,18 +2489,10 @@ class OSBuildImage(BaseTaskHandler):
             raise koji.BuildError("Unsupported architecture(s): " + str(diff))
 
         # Repositories
-        repo_urls = opts.get("repo")
         if repo_urls:
             repos = self.make_repos_for_user(repo_urls)
         else:
-            repos = self.make_repos_for_target(target_info)
-
-        client = self.client
-
-        # Version and names
-        nvr = NVR(name, version, opts.get("release"))
-        if not nvr.release:
-            nvr.release = self.session.getNextRelease(nvr.as_dict())
+            repos = self.make_repos_for_target(target_info, repo_info)
 
         # Arches and image type
         image_type = self.map_koji_api_image_type(image_type)
@@ -705,6 +2518,8 @@ class OSBuildImage(BaseTaskHandler):
 
         self.logger.debug("Composer API: %s", self.client.url)
 
+        self.image_names = [f"{i.architecture}-{i.image_type}" for i in ireqs]
+
         # Setup done, create the compose request and send it off
         kojidata = ComposeRequest.Koji(self.koji_url, self.id, nvr)
         request = ComposeRequest(distro, ireqs, kojidata)
@@ -714,27 +2529,17 @@ class OSBuildImage(BaseTaskHandler):
 
         self.upload_json(request.as_dict(), "compose-request")
 
-        cid = client.compose_create(request)
-        self.logger.info("Compose id: %s", cid)
-
-        self.logger.debug("Waiting for compose to finish")
-        status = client.wait_for_compose(cid, callback=self.on_status_update)
-
-        self.logger.debug("Compose finished: %s", str(status.as_dict()))
-        self.logger.info("Compose result: %s", status.status)
+        # Only composes from build tag repos can be reused: their urls
+        # contain the repo id and thus identify the content. Bumping
+        # the release explicitly is the way to force a new build.
+        cid, bid, reused = self.make_compose(request, ireqs, reusable=not repo_urls,
+                                             with_release=bool(opts.get("release")),
+                                             fail_fast=opts.get("fail_fast", False))
 
-        self.attach_manifests(cid, ireqs)
-        self.attach_logs(cid, ireqs)
-
-        if not status.is_success:
-            raise koji.BuildError(f"Compose failed (id: {cid})")
-
-        # Successful compose, must have a build id associated
-        bid = status.koji_build_id
-
-        # Build was successful, tag it
+        # Build was successful, tag it; a reused build most likely
+        # already is and tagging it again would fail
         if not opts.get('skip_tag'):
-            self.tag_build(target_info["dest_tag"], bid)
+            self.tag_build(target_info["dest_tag"], bid, unless_tagged=reused)
 
         result = {
             "composer": {
@@ -781,13 +2586,11 @@ def compose_cmd(client: Client, args):
     cid = client.compose_create(request)
 
     print(f"Compose: {cid}")
-    while True:
-        status = client.compose_status(cid)
+
+    def show_progress(status):
         print(f"status: {status.status: <10}\r", end="")
-        if status.is_finished:
-            break
 
-        time.sleep(2)
+    status = client.wait_for_compose(cid, callback=show_progress)
 
     show_compose(status)
     return 0
@@ -805,6 +2608,37 @@ def wait_cmd(client: Client, args):
     return 0
 
 
+def cancel_cmd(client: Client, args):
+    client.compose_cancel(args.id)
+    return 0
+
+
+def mux_cmd(args):
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger('koji.plugin.osbuild')
+
+    cfg = read_config(args.config)
+    path = args.socket
+    if not path and "composer:mux" in cfg:
+        path = cfg["composer:mux"].get("socket")
+    if not path:
+        print(f"{RED}Error{RESET}: Need socket path", file=sys.stderr)
+        return 1
+
+    pool = make_pool(cfg, logger)
+    mux = StatusMux(pool.clients[0], path, logger, clients=pool.clients)
+
+    try:
+        mux.serve()
+    except KeyboardInterrupt:
+        pass
+    except koji.GenericError as e:
+        print(f"{RED}Error{RESET}: {e}", file=sys.stderr)
+        return 1
+
+    return 0
+
+
 def main():
     import argparse  # pylint: disable=import-outside-toplevel
 
@@ -816,6 +2650,13 @@ def main():
                         type=str)
     parser.add_argument("--ca", metavar="ca", help='The SSL certificate authority',
                         type=str)
+    parser.add_argument("--poll", metavar="STRATEGY", help='The polling strategy [fixed]',
+                        type=str, choices=list(POLL_STRATEGIES), default=PollStrategy.name)
+    parser.add_argument("--poll-interval", metavar="SECONDS", help='The (initial) polling interval',
+                        type=float, default=None)
+    parser.add_argument("--poll-max-interval", metavar="SECONDS",
+                        help='The maximal polling interval',
+                        type=float, default=None)
     parser.set_defaults(cmd=None)
     sp = parser.add_subparsers(help='commands')
 
@@ -842,6 +2683,17 @@ def main():
     subpar.add_argument("id", metavar="COMPOSE_ID", help='compose id')
     subpar.set_defaults(cmd='wait')
 
+    subpar = sp.add_parser("cancel", help='cancel a compose')
+    subpar.add_argument("id", metavar="COMPOSE_ID", help='compose id')
+    subpar.set_defaults(cmd='cancel')
+
+    subpar = sp.add_parser("mux", help='run the host-wide compose status multiplexer')
+    subpar.add_argument("--socket", metavar="PATH", help='The unix socket to listen on',
+                        type=str)
+    subpar.add_argument("--config", metavar="FILE", help='The builder config to use',
+                        type=str, action="append", default=None)
+    subpar.set_defaults(cmd='mux')
+
     args = parser.parse_args()
 
     if not args.cmd:
@@ -849,6 +2701,10 @@ def main():
         parser.print_help(sys.stderr)
         return 1
 
+    # the multiplexer is configured via the builder config
+    if args.cmd == "mux":
+        return mux_cmd(args)
+
     client = Client(args.url)
 
     if args.cert:
@@ -859,13 +2715,19 @@ def main():
     if args.ca:
         client.http.verify = args.ca
 
-    if args.cmd == "compose":
-        return compose_cmd(client, args)
-    if args.cmd == "status":
-        return status_cmd(client, args)
-    if args.cmd == "wait":
-        return wait_cmd(client, args)
-    return 1
+    client.poll_strategy = PollStrategy.from_config({
+        "strategy": args.poll,
+        "interval": args.poll_interval,
+        "max_interval": args.poll_max_interval,
+    })
+
+    commands = {
+        "compose": compose_cmd,
+        "status": status_cmd,
+        "wait": wait_cmd,
+        "cancel": cancel_cmd,
+    }
+    return commands[args.cmd](client, args)
 
 
 if __name__ == "__main__":
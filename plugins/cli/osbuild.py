@@ -47,6 +47,10 @@ def parse_args(argv):
 
     parser = kl.OptionParser(usage=kl.get_usage_str(usage))
 
+    parser.add_option("--from-file", type=str, default=None, dest="from_file", metavar="FILE",
+                      help=("Submit all images described in FILE (json or yaml list); "
+                            "no positional arguments are allowed in this mode, the "
+                            "other options are the defaults for all images"))
     parser.add_option("--customizations", type=str, default=None, dest="customizations",
                       help="Additional customizations to pass to Composer (json file)")
     parser.add_option("--upload-options", type=str, default=None, dest="upload_options",
@@ -74,10 +78,17 @@ def parse_args(argv):
                       type=str, default="guest-image")
     parser.add_option("--skip-tag", action="store_true",
                       help="Do not attempt to tag package")
+    parser.add_option("--fail-fast", action="store_true", dest="fail_fast",
+                      help="Cancel the compose as soon as one image failed")
     parser.add_option("--wait", action="store_true",
                       help="Wait on the image creation, even if running in the background")
 
     opts, args = parser.parse_args(argv)
+    if opts.from_file:
+        if args:
+            parser.error("No positional arguments are allowed with --from-file")
+        return opts
+
     if len(args) < 5:
         parser.error("At least five arguments are required: a name, "
                      "a version, a distribution, a build target, "
@@ -102,15 +113,125 @@ def check_target(session, name):
         raise koji.GenericError(f"Unknown destination tag: {target['dest_tag_name']}")
 
 
-# pylint: disable=too-many-branches
-@export_cli
-def handle_osbuild_image(options, session, argv):
-    "[build] Build images via osbuild"
-    args = parse_args(argv)
+IMAGE_SPEC_KEYS = ("name", "version", "distro", "image_type", "target", "arches", "opts")
+IMAGE_SPEC_REQUIRED = ("name", "version", "distro", "target", "arches")
 
-    name, version, arch, target = args.name, args.version, args.arch, args.target
-    distro, image_type = args.distro, args.image_type
 
+def load_image_specs(path, *, image_type="guest-image", opts=None):
+    """Load and check the list of image specifications in `path`
+
+    Files ending in `.yaml` or `.yml` are parsed as YAML, everything
+    else as JSON. Each entry is a dictionary with the arguments of
+    `osbuildImage`; `image_type` defaults to the given one and the
+    `opts` of each image are added to the given ones.
+    """
+
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml  # pylint: disable=import-outside-toplevel
+            except ImportError as e:
+                raise koji.GenericError("YAML support requires PyYAML") from e
+            specs = yaml.safe_load(f)
+        else:
+            specs = json.load(f)
+
+    if not isinstance(specs, list):
+        raise koji.GenericError(f"{path}: expected a list of images")
+
+    images = []
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            raise koji.GenericError(f"{path}: image {i}: expected a dictionary")
+
+        unknown = set(spec.keys()) - set(IMAGE_SPEC_KEYS)
+        if unknown:
+            raise koji.GenericError(f"{path}: image {i}: unknown keys: "
+                                    f"{', '.join(sorted(unknown))}")
+
+        missing = [k for k in IMAGE_SPEC_REQUIRED if k not in spec]
+        if missing:
+            raise koji.GenericError(f"{path}: image {i}: missing keys: {', '.join(missing)}")
+
+        image = {
+            "image_type": image_type,
+            **spec,
+            "opts": {**(opts or {}), **spec.get("opts", {})},
+        }
+        images.append(image)
+
+    return images
+
+
+def submit_images(session, images):
+    """Create tasks for all `images`
+
+    Uses the `osbuildImageBatch` hub call if the hub provides it and
+    falls back to a multicall of `osbuildImage` otherwise. Returns a
+    list with either `{"task_id": <id>}` or `{"error": <msg>}` for each
+    image, in the same order.
+    """
+
+    try:
+        return session.osbuildImageBatch(images)
+    except koji.GenericError as e:
+        if "osbuildImageBatch" not in str(e):
+            raise
+
+    with session.multicall(strict=False) as m:
+        calls = [
+            m.osbuildImage(*[image[k] for k in IMAGE_SPEC_KEYS[:-1]], opts=image["opts"])
+            for image in images
+        ]
+
+    results = []
+    for call in calls:
+        try:
+            results.append({"task_id": call.result})
+        except koji.GenericError as e:
+            results.append({"error": str(e)})
+    return results
+
+
+def handle_from_file(options, session, args):
+    """Submit all images from `args.from_file` and watch the tasks"""
+
+    images = load_image_specs(args.from_file, image_type=args.image_type,
+                              opts=make_opts(args))
+
+    # Every target is only checked once, no matter how many images use it
+    for target in sorted({image["target"] for image in images}):
+        check_target(session, target)
+
+    kl.activate_session(session, options)
+
+    results = submit_images(session, images)
+
+    task_ids, failed = [], 0
+    for image, res in zip(images, results):
+        desc = f"{image['name']}-{image['version']} ({image['image_type']}, {image['target']})"
+        if "error" in res:
+            failed += 1
+            print(f"Failed to create task for {desc}: {res['error']}")
+            continue
+
+        task_id = res["task_id"]
+        task_ids.append(task_id)
+        if not options.quiet:
+            print(f"Created task {task_id} for {desc}")
+            print(f"Task info: {options.weburl}/taskinfo?taskID={task_id}")
+
+    # pylint: disable=protected-access
+    if (args.wait is None and kl._running_in_bg()) or args.wait is False or not task_ids:
+        return 1 if failed else None
+
+    session.logout()
+    res = kl.watch_tasks(session, task_ids, quiet=options.quiet)
+    return 1 if failed else res
+
+
+def make_opts(args):
+    """The `osbuildImage` options from the command line options"""
     opts = {}
 
     if args.release:
@@ -122,6 +243,9 @@ def handle_osbuild_image(options, session, argv):
     if args.skip_tag:
         opts["skip_tag"] = True
 
+    if args.fail_fast:
+        opts["fail_fast"] = True
+
     # ostree command line parameters
     ostree = {}
 
@@ -147,6 +271,22 @@ def handle_osbuild_image(options, session, argv):
         with open(args.upload_options, "r", encoding="utf-8") as f:
             opts["upload_options"] = json.load(f)
 
+    return opts
+
+
+@export_cli
+def handle_osbuild_image(options, session, argv):
+    "[build] Build images via osbuild"
+    args = parse_args(argv)
+
+    if args.from_file:
+        return handle_from_file(options, session, args)
+
+    name, version, arch, target = args.name, args.version, args.arch, args.target
+    distro, image_type = args.distro, args.image_type
+
+    opts = make_opts(args)
+
     # Do some early checks to be able to give quick feedback
     check_target(session, target)
 
@@ -140,6 +140,10 @@ OSBUILD_IMAGE_SCHEMA = {
                 "skip_tag": {
                     "type": "boolean",
                     "description": "Omit tagging the result"
+                },
+                "fail_fast": {
+                    "type": "boolean",
+                    "description": "Cancel the compose as soon as one image failed"
                 }
             }
         },
@@ -232,19 +236,24 @@ OSBUILD_IMAGE_SCHEMA = {
 }
 
 
-@koji.plugin.export
-def osbuildImage(name, version, distro, image_type, target, arches, opts=None, priority=None):
-    """Create an image via osbuild"""
-    context.session.assertPerm("image")
-    args = [name, version, distro, image_type, target, arches, opts]
-    task = {"channel": "image"}
+# The validator is created once, at plugin load time, since creating it,
+# as `jsonschema.validate` does for every call, is the dominating cost
+# of the validation.
+OSBUILD_IMAGE_VALIDATOR = jsonschema.Draft4Validator(OSBUILD_IMAGE_SCHEMA)
 
-    logger.info("Create osbuildImage task")
 
-    try:
-        jsonschema.validate(args, OSBUILD_IMAGE_SCHEMA)
-    except jsonschema.exceptions.ValidationError as err:
-        raise koji.ParameterError(str(err)) from None
+def validate_args(args):
+    """Validate the arguments of `osbuildImage` against the schema"""
+    error = jsonschema.exceptions.best_match(OSBUILD_IMAGE_VALIDATOR.iter_errors(args))
+    if error is not None:
+        raise koji.ParameterError(str(error)) from None
+
+
+def prepare_args(name, version, distro, image_type, target, arches, opts):
+    """Validate and normalize the arguments for an `osbuildImage` task"""
+    args = [name, version, distro, image_type, target, arches, opts]
+
+    validate_args(args)
 
     # Support array for backwards compatibility
     # This check must be done after the schema validation
@@ -252,9 +261,26 @@ def osbuildImage(name, version, distro, image_type, target, arches, opts=None, p
         image_type = image_type[0]
         args = [name, version, distro, image_type, target, arches, opts]
 
+    return args
+
+
+def check_priority(priority):
     if priority and priority < 0 and not context.session.hasPerm('admin'):
         raise koji.ActionNotAllowed('only admins may create high-priority tasks')
 
+
+@koji.plugin.export
+def osbuildImage(name, version, distro, image_type, target, arches, opts=None, priority=None):
+    """Create an image via osbuild"""
+    context.session.assertPerm("image")
+    task = {"channel": "image"}
+
+    logger.info("Create osbuildImage task")
+
+    args = prepare_args(name, version, distro, image_type, target, arches, opts)
+
+    check_priority(priority)
+
     # If task_id is returned from Koji Hub we assume
     # that the task has been added to the database
     task_id = kojihub.make_task('osbuildImage', args, **task)
@@ -262,3 +288,59 @@ def osbuildImage(name, version, distro, image_type, target, arches, opts=None, p
         logger.info("osbuildImage task %i added to database", task_id)
 
     return task_id
+
+
+BATCH_IMAGE_KEYS = ("name", "version", "distro", "image_type", "target", "arches", "opts")
+
+
+@koji.plugin.export
+def osbuildImageBatch(images, priority=None):
+    """Create multiple images via osbuild
+
+    Each entry of `images` is a dictionary with the arguments of
+    `osbuildImage`, i.e. `name`, `version`, `distro`, `image_type`,
+    `target`, `arches` and `opts`. All entries are validated first
+    and tasks are then created for all valid ones, within the same
+    transaction.
+
+    Returns a list with one entry per image, in the same order: either
+    `{"task_id": <id>}` or, if the entry was invalid, `{"error": <msg>}`.
+    """
+    context.session.assertPerm("image")
+    task = {"channel": "image"}
+
+    if not isinstance(images, list):
+        raise koji.ParameterError("images must be a list")
+
+    check_priority(priority)
+
+    logger.info("Create %i osbuildImage tasks", len(images))
+
+    results = []
+    for image in images:
+        if not isinstance(image, dict):
+            results.append({"error": "image must be a dictionary"})
+            continue
+
+        unknown = set(image.keys()) - set(BATCH_IMAGE_KEYS)
+        if unknown:
+            results.append({"error": f"unknown keys: {', '.join(sorted(unknown))}"})
+            continue
+
+        try:
+            args = prepare_args(*[image.get(k) for k in BATCH_IMAGE_KEYS])
+        except koji.ParameterError as e:
+            results.append({"error": str(e)})
+            continue
+
+        results.append({"args": args})
+
+    for res in results:
+        args = res.pop("args", None)
+        if args is None:
+            continue
+
+        res["task_id"] = kojihub.make_task('osbuildImage', args, **task)
+        logger.info("osbuildImage task %i added to database", res["task_id"])
+
+    return results
@@ -5,11 +5,17 @@
 #pylint: disable=too-many-lines
 
 import configparser
+import email.utils
 import json
 import os
 import re
+import signal
+import socket
+import stat
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urllib.parse
 import uuid
@@ -87,9 +93,12 @@ class MockComposer:  # pylint: disable=too-many-instance-attributes
         self.errors = []
         self.build_id = 1
         self.status = "success"
+        # per image status of new composes, defaults to `status`
+        self.image_statuses = None
         self.routes = {}
         self.oauth = None
         self.oauth_check_delay = 0
+        self.healthy = True
 
     def httpretty_register(self):
         httpretty.register_uri(
@@ -98,6 +107,17 @@ class MockComposer:  # pylint: disable=too-many-instance-attributes
             body=self.compose_create
         )
 
+        httpretty.register_uri(
+            httpretty.GET,
+            urllib.parse.urljoin(self.url, "openapi"),
+            body=self.openapi
+        )
+
+    def openapi(self, _request, _uri, response_headers):
+        if not self.healthy:
+            return [503, response_headers, "Service Unavailable"]
+        return [200, response_headers, "{}"]
+
     def next_build_id(self):
         build_id = self.build_id
         self.build_id += 1
@@ -137,6 +157,7 @@ class MockComposer:  # pylint: disable=too-many-instance-attributes
             "request": js,
             "result": compose,
             "status": self.status,
+            "image_statuses": self.image_statuses,
             "routes": {
                 "logs": 200,
                 "manifests": 200
@@ -161,6 +182,12 @@ class MockComposer:  # pylint: disable=too-many-instance-attributes
             body=self.compose_manifests
         )
 
+        httpretty.register_uri(
+            httpretty.POST,
+            urllib.parse.urljoin(self.url, "composes/" + compose_id + "/cancel"),
+            body=self.compose_cancel
+        )
+
         return [201, response_headers, json.dumps(compose)]
 
     def compose_status(self, request, uri, response_headers):
@@ -174,17 +201,32 @@ class MockComposer:  # pylint: disable=too-many-instance-attributes
             return [400, response_headers, f"Unknown compose: {target}"]
 
         ireqs = compose["request"]["image_requests"]
+        statuses = compose["image_statuses"] or [compose["status"] for _ in ireqs]
         result = {
             "status": compose["status"],
             "koji_status": {
                 "build_id": compose["build_id"],
             },
             "image_statuses": [
-                {"status": compose["status"]} for _ in ireqs
+                {"status": status} for status in statuses
             ]
         }
         return [200, response_headers, json.dumps(result)]
 
+    def compose_cancel(self, request, uri, response_headers):
+        check = self.oauth_check(request, response_headers)
+        if check:
+            return check
+
+        target = os.path.basename(os.path.dirname(uri))
+        compose = self.composes.get(target)
+        if not compose:
+            return [404, response_headers, f"Unknown compose: {target}"]
+
+        compose["status"] = "failure"
+        compose["canceled"] = True
+        return [200, response_headers, ""]
+
     def compose_logs(self, request, uri, response_headers):
         check = self.oauth_check(request, response_headers)
         if check:
@@ -340,6 +382,34 @@ class MockComposerStatus:
             body=self.compose_status
         )
 
+class MockStatusClient:
+    """Stand-in for the composer `Client` used by the status multiplexer
+
+    Composes stay pending until `release` is set and then succeed.
+    Unknown composes result in an error, like with composer.
+    """
+
+    def __init__(self, plugin, compose_id):
+        self.plugin = plugin
+        self.compose_id = compose_id
+        self.server = plugin.DEFAULT_COMPOSER_URL
+        self.poll_strategy = plugin.PollStrategy(0.01)
+        self.release = threading.Event()
+        self.calls = 0
+
+    def compose_status(self, compose_id):
+        if compose_id != self.compose_id:
+            raise koji.GenericError(f"Unknown compose: {compose_id}")
+
+        self.calls += 1
+        status = "success" if self.release.is_set() else "pending"
+        return self.plugin.ComposeStatus.from_dict({
+            "status": status,
+            "koji_status": {"build_id": 42},
+            "image_statuses": [{"status": status}]
+        })
+
+
 class UploadTracker:
     """Mock koji file uploading and keep track of uploaded files
 
@@ -356,11 +426,20 @@ class UploadTracker:
                 self._fast_incremental_upload)
 
     def _fast_incremental_upload(self, _session, name, fd, path, _tries, _log):
-        upload = self.uploads.get(name, {"path": path})
-        fd.seek(0, os.SEEK_END)
+        upload = self.uploads.get(name, {"path": path, "count": 0, "writes": []})
+        offset = fd.tell()
+        upload["writes"].append((offset, fd.read()))
+        upload["count"] += 1
         upload["pos"] = fd.tell()
         self.uploads[name] = upload
 
+    def content(self, name):
+        """Reassemble the content of an upload from all writes"""
+        data = ""
+        for offset, chunk in self.uploads[name]["writes"]:
+            data = data[:offset] + chunk
+        return data
+
     def assert_upload(self, name):
         if name not in self.uploads:
             raise AssertionError(f"Upload {name} missing")
@@ -426,10 +505,50 @@ class MockHost:
         assert isinstance(build, int), "tagBuild: build id not int"
 
         tags = self.tags.get(build, [])
+        if tag in tags:
+            raise koji.TagError(f"build {build} already tagged ({tag})")
         tags += [tag]
         self.tags[build] = tags
 
 
+class MockMultiCall:
+    """Mock for koji's MultiCallSession
+
+    Calls are forwarded to the (mocked) session right away and their
+    results are returned via the `result` property, like the virtual
+    calls of the real multicall session. The names of the methods
+    called in each batch are recorded in `batches`.
+    """
+
+    def __init__(self, session, batches):
+        self.session = session
+        self.batches = batches
+        self.calls = []
+
+    @classmethod
+    def patch(cls, session):
+        """Add `multicall` to the session, returns the list of batches"""
+        batches = []
+        session.should_receive("multicall") \
+               .replace_with(lambda **_kwargs: cls(session, batches))
+        return batches
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.batches.append(self.calls)
+        return False
+
+    def __getattr__(self, name):
+        method = getattr(self.session, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return flexmock(result=method(*args, **kwargs))
+        return call
+
+
 @PluginTest.load_plugin("builder")
 class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
 
@@ -437,6 +556,8 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
         super().setUp()
         self.uploads = UploadTracker()
         self.uploads.patch(self.plugin)
+        # the handler may install a handler for SIGTERM
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.getsignal(signal.SIGTERM))
 
     @staticmethod
     def mock_session():
@@ -488,6 +609,19 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
                .with_args(dict) \
                .and_return("20201015")
 
+        session.should_receive("listTags") \
+               .replace_with(lambda build: [{"id": t, "name": f"tag-{t}"}
+                                            for t in host.tags.get(build, [])])
+
+        session.should_receive("subsession") \
+               .replace_with(lambda: flexmock(logout=lambda: None))
+
+        # no output of a previous run of the task
+        session.should_receive("downloadTaskOutput") \
+               .and_raise(koji.GenericError("No such file"))
+
+        MockMultiCall.patch(session)
+
         return session
 
     @staticmethod
@@ -524,6 +658,30 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
             self.plugin.DEFAULT_CONFIG_FILES = [cfgfile]
             return creator()
 
+    def test_import_time(self):
+        # The plugin is loaded by every kojid process, make sure that
+        # loading it does not import anything besides what koji itself
+        # already needs; everything else must be imported on use.
+        root = os.getenv("GITHUB_WORKSPACE", os.getcwd())
+        path = os.path.join(root, "plugins", "builder", "osbuild.py")
+
+        script = (
+            "import importlib.util, sys\n"
+            "import koji, koji.daemon, koji.tasks\n"
+            "print('-- plugin --', file=sys.stderr, flush=True)\n"
+            f"spec = importlib.util.spec_from_file_location('osbuild', {path!r})\n"
+            "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+        )
+
+        r = subprocess.run([sys.executable, "-X", "importtime", "-c", script],
+                           encoding="utf-8", capture_output=True, check=True)
+
+        _, _, output = r.stderr.partition("-- plugin --\n")
+        imported = [line.split("|")[-1].strip()
+                    for line in output.splitlines()
+                    if line.startswith("import time:")]
+        self.assertEqual(imported, [])
+
     def test_plugin_config(self):
 
         composer_url = "https://image-builder.osbuild.org:2323"
@@ -583,6 +741,12 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
             .with_args("target", strict=True) \
             .and_return(None)
 
+        # looked up in the same batch as the target
+        session.should_receive("getNextRelease") \
+            .and_return("1")
+
+        MockMultiCall.patch(session)
+
         options = flexmock(allowed_scms='pkg.osbuild.org:/*:no',
                            workdir="/tmp")
         handler = self.plugin.OSBuildImage(1,
@@ -618,6 +782,11 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
                .with_args(build_target["build_tag"]) \
                .and_return({"arches": "x86_64"})
 
+        session.should_receive("getNextRelease") \
+               .and_return("1")
+
+        batches = MockMultiCall.patch(session)
+
         options = flexmock(allowed_scms='pkg.osbuild.org:/*:no',
                            workdir="/tmp")
 
@@ -637,6 +806,11 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
             handler.handler(*args)
             self.assertTrue(str(err).startswith("Unsupported"))
 
+        # the target and release, then the build config are fetched in
+        # two batches; no repo lookup since user repos are given
+        self.assertEqual(batches, [["getBuildTarget", "getNextRelease"],
+                                   ["getBuildConfig"]])
+
 
     @httpretty.activate
     def test_bad_request(self):
@@ -658,6 +832,317 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
 
         self.uploads.assert_upload("compose-request.json")
 
+    @httpretty.activate
+    def test_target_repo(self):
+        # No user repositories: the repo of the build tag is fetched
+        # together with the build config in a single multicall
+        session = self.mock_session()
+        batches = MockMultiCall.patch(session)
+        handler = self.make_handler(session=session)
+
+        arches = ["x86_64"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {}]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+
+        res = handler.handler(*args)
+        compose = composer.composes.get(res["composer"]["id"])
+
+        self.assertEqual(batches, [["getBuildTarget", "getNextRelease"],
+                                   ["getBuildConfig", "getRepo"]])
+
+        ireqs = compose["request"]["image_requests"]
+        have = [r["baseurl"] for r in ireqs[0]["repositories"]]
+        self.assertEqual(have, ["http://localhost/kojifiles/repos/fedora-build/20201015/x86_64"])
+
+    def test_hub_cache(self):
+        target = {"build_tag": 23, "build_tag_name": "fedora-build"}
+        config = {"arches": "x86_64"}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = self.plugin.HubCache(os.path.join(tmp, "hub.json"), ttl=60)
+
+            self.assertIsNone(cache.get_target("fedora-candidate"))
+            self.assertIsNone(cache.get_build_tag(23))
+
+            cache.put_target("fedora-candidate", target)
+            cache.put_build_tag(23, config, None)
+
+            # shared with other instances, i.e. processes
+            other = self.plugin.HubCache(cache.path, ttl=60)
+            self.assertEqual(other.get_target("fedora-candidate"), target)
+            self.assertEqual(other.get_build_tag(23), (config, None))
+
+            # a repo that appeared later is recorded, but not replaced
+            cache.put_repo(23, 1)
+            cache.put_repo(23, 2)
+            self.assertEqual(cache.get_build_tag(23), (config, 1))
+
+            # invalidating the tag drops the targets using it as well
+            cache.put_target("other-candidate", {"build_tag": 5})
+            cache.invalidate(23)
+            self.assertIsNone(cache.get_target("fedora-candidate"))
+            self.assertIsNone(cache.get_build_tag(23))
+            self.assertEqual(cache.get_target("other-candidate"), {"build_tag": 5})
+
+            # entries expire after the ttl
+            cache.put_target("fedora-candidate", target)
+            cache.put_build_tag(23, config, 1)
+            expired = self.plugin.HubCache(cache.path, ttl=0)
+            time.sleep(0.01)
+            self.assertIsNone(expired.get_target("fedora-candidate"))
+            self.assertIsNone(expired.get_build_tag(23))
+
+    @httpretty.activate
+    def test_hub_cache_handler(self):
+        arches = ["x86_64"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {}]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = configparser.ConfigParser()
+            cfg["composer"] = {"server": url}
+            cfg["koji"] = {
+                "server": self.plugin.DEFAULT_KOJIHUB_URL,
+                "cache": os.path.join(tmp, "hub.json"),
+                "cache_ttl": "300",
+            }
+
+            batches = []
+            for repo_id in [1, 1, 2]:
+                session = self.mock_session()
+                session.should_receive("getRepo") \
+                       .and_return({"id": repo_id, "event_id": 2121})
+                batches.append(MockMultiCall.patch(session))
+                if repo_id == 2:
+                    session.should_receive("getBuildConfig").once() \
+                           .and_return({"arches": "x86_64"})
+                handler = self.make_handler(config=cfg, session=session)
+                res = handler.handler(*args)
+                assert res, "invalid compose result"
+
+        self.assertEqual(batches[0], [["getBuildTarget", "getNextRelease"],
+                                      ["getBuildConfig", "getRepo"]])
+        # the second task only needs the next release and the current repo
+        self.assertEqual(batches[1], [["getNextRelease"], ["getRepo"]])
+        # a new repo means the build config is fetched again
+        self.assertEqual(batches[2], [["getNextRelease"], ["getRepo"]])
+
+    @httpretty.activate
+    def test_compose_reuse(self):
+        arches = ["x86_64"]
+
+        def make_args(opts):
+            return ["name", "version", "distro",
+                    "image_type",
+                    "fedora-candidate",
+                    arches,
+                    opts]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = configparser.ConfigParser()
+            cfg["composer"] = {"server": url}
+            cfg["koji"] = {
+                "server": self.plugin.DEFAULT_KOJIHUB_URL,
+                "compose_index": os.path.join(tmp, "composes.json"),
+            }
+
+            session = self.mock_session()
+            handler = self.make_handler(config=cfg, session=session)
+            res = handler.handler(*make_args({}))
+            compose_id, build_id = res["composer"]["id"], res["koji"]["build"]
+            self.assertEqual(session.host.tags.get(build_id), [42])
+
+            # an identical request, albeit with the next release, reuses
+            # the compose and the existing build, which already is tagged
+            session.should_receive("getNextRelease") \
+                   .and_return("20201016")
+            session.should_receive("getBuild") \
+                   .with_args(build_id) \
+                   .and_return({"id": build_id, "state": koji.BUILD_STATES["COMPLETE"]})
+
+            handler = self.make_handler(config=cfg, session=session)
+            res = handler.handler(*make_args({}))
+
+            self.assertEqual(res["composer"]["id"], compose_id)
+            self.assertEqual(res["koji"]["build"], build_id)
+            self.assertEqual(len(composer.composes), 1)
+            self.assertEqual(session.host.tags.get(build_id), [42])
+            self.assertEqual(session.host.count, 1)
+            self.uploads.assert_upload("compose-reuse.json")
+
+            # if the build is not tagged (anymore), it gets tagged
+            session.host.tags.clear()
+            handler = self.make_handler(config=cfg, session=session)
+            res = handler.handler(*make_args({}))
+            self.assertEqual(res["koji"]["build"], build_id)
+            self.assertEqual(session.host.tags.get(build_id), [42])
+            self.assertEqual(len(composer.composes), 1)
+
+            # an explicitly requested release forces a new build
+            handler = self.make_handler(config=cfg, session=session)
+            res = handler.handler(*make_args({"release": "2"}))
+            self.assertNotEqual(res["composer"]["id"], compose_id)
+            self.assertEqual(len(composer.composes), 2)
+
+            # different content is not reused
+            handler = self.make_handler(config=cfg, session=session)
+            res = handler.handler(*make_args({"customizations": {"packages": ["emacs"]}}))
+            self.assertNotEqual(res["composer"]["id"], compose_id)
+            self.assertEqual(len(composer.composes), 3)
+
+            # neither are composes of builds that are gone
+            session = self.mock_session()
+            session.should_receive("getBuild") \
+                   .with_args(build_id) \
+                   .and_return({"id": build_id, "state": koji.BUILD_STATES["DELETED"]})
+
+            handler = self.make_handler(config=cfg, session=session)
+            res = handler.handler(*make_args({}))
+            self.assertNotEqual(res["composer"]["id"], compose_id)
+            self.assertEqual(len(composer.composes), 4)
+
+    @httpretty.activate
+    def test_compose_cancel(self):
+        arches = ["x86_64"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {"repo": ["https://1.repo"]}]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+        composer.status = "pending"
+
+        def terminate(_cid, **_kwargs):
+            # like kojid does when the task gets canceled
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(1)
+
+        def fail(_cid, **_kwargs):
+            raise koji.GenericError("Failed to get the compose status")
+
+        for state, wait, exception, canceled in [
+                ("CANCELED", terminate, SystemExit, True),
+                # kojid is shutting down, compose will be resumed
+                ("OPEN", terminate, SystemExit, False),
+                # the task will fail
+                ("OPEN", fail, koji.GenericError, True),
+        ]:
+            session = self.mock_session()
+            session.should_receive("getTaskInfo") \
+                   .with_args(1) \
+                   .and_return({"id": 1, "state": koji.TASK_STATES[state]})
+
+            handler = self.make_handler(session=session)
+            flexmock(handler).should_receive("wait_for_compose").replace_with(wait)
+
+            with self.assertRaises(exception):
+                handler.handler(*args)
+
+            compose_id = json.loads(self.uploads.content("compose-id.json"))["compose_id"]
+            compose = composer.composes[compose_id]
+            self.assertEqual(compose.get("canceled", False), canceled)
+
+    @httpretty.activate
+    def test_compose_fail_fast(self):
+        arches = ["x86_64", "s390x"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {"repo": ["https://1.repo"], "fail_fast": True}]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+        # one image failed, the other one is still building
+        composer.status = "pending"
+        composer.image_statuses = ["failure", "building"]
+
+        handler = self.make_handler()
+
+        with self.assertRaises(koji.BuildError):
+            handler.handler(*args)
+
+        compose_id = json.loads(self.uploads.content("compose-id.json"))["compose_id"]
+        compose = composer.composes[compose_id]
+        self.assertTrue(compose.get("canceled"))
+
+    @httpretty.activate
+    def test_compose_resume(self):
+        arches = ["x86_64"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {"repo": ["https://1.repo"]}]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+
+        # the first run records the compose id
+        handler = self.make_handler()
+        res = handler.handler(*args)
+        compose_id = res["composer"]["id"]
+
+        self.assertEqual(json.loads(self.uploads.content("compose-id.json")),
+                         {"composer": url, "compose_id": compose_id})
+
+        # the second run, e.g. after a restart of kojid, re-attaches
+        # to the existing compose instead of creating a new one
+        session = self.mock_session()
+        outputs = {}
+        for name in ["compose-id.json",
+                     "compose-status-history.ndjson",
+                     "compose-timeline.ndjson"]:
+            outputs[name] = self.uploads.content(name)
+            session.should_receive("downloadTaskOutput") \
+                   .with_args(1, name) \
+                   .and_return(outputs[name].encode("utf-8"))
+
+        handler = self.make_handler(session=session)
+        res = handler.handler(*args)
+
+        self.assertEqual(res["composer"]["id"], compose_id)
+        self.assertEqual(len(composer.composes), 1)
+
+        # the append-only outputs of the first run are continued
+        history = self.uploads.content("compose-status-history.ndjson")
+        self.assertTrue(history.startswith(outputs["compose-status-history.ndjson"]))
+        self.assertGreater(len(history), len(outputs["compose-status-history.ndjson"]))
+        # ... without recording the transitions of the first run again
+        self.assertEqual(self.uploads.content("compose-timeline.ndjson"),
+                         outputs["compose-timeline.ndjson"])
+
+        # an unknown compose is not resumed
+        del composer.composes[compose_id]
+        handler = self.make_handler(session=session)
+        res = handler.handler(*args)
+
+        self.assertNotEqual(res["composer"]["id"], compose_id)
+        self.assertEqual(len(composer.composes), 1)
+
     @httpretty.activate
     def test_compose_success(self):
         # Simulate a successful compose, check return value
@@ -699,6 +1184,7 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
             self.uploads.assert_upload(f"{arch}-image_type.manifest.json")
         self.uploads.assert_upload("compose-request.json")
         self.uploads.assert_upload("compose-status.json")
+        self.uploads.assert_upload("compose-timeline.ndjson")
         self.uploads.assert_upload("koji-init.log.json")
         self.uploads.assert_upload("koji-import.log.json")
 
@@ -1267,3 +1753,988 @@ class TestBuilderPlugin(PluginTest): # pylint: disable=too-many-public-methods
 
         client = self.plugin.Client("http://localhost")
         client.wait_for_compose(compose_id, sleep_time=0.1)
+
+    def test_compose_status_transient(self):
+        client = self.plugin.Client("http://localhost")
+        status = self.plugin.ComposeStatus.from_dict({
+            "status": "success",
+            "koji_status": {"build_id": 42},
+            "image_statuses": [{"status": "success"}]
+        })
+
+        # failed connections do not end waiting for the compose
+        flexmock(client) \
+            .should_receive("compose_status") \
+            .and_raise(self.plugin.RequestFailed("Connection reset")) \
+            .and_return(status) \
+            .twice()
+
+        res = client.wait_for_compose("42", sleep_time=0.01)
+        self.assertTrue(res.is_success)
+
+        # only the deadline does
+        flexmock(client) \
+            .should_receive("compose_status") \
+            .and_raise(self.plugin.RequestFailed("Connection refused"))
+
+        with self.assertRaises(self.plugin.DeadlineExceeded):
+            client.wait_for_compose("42", sleep_time=0.01, deadline=time.monotonic() + 0.1)
+
+        # without a deadline, waiting ends once composer was unreachable
+        # for too long in a row
+        self.assertIsNotNone(client.UNREACHABLE_MAX)
+        flexmock(client) \
+            .should_receive("compose_status") \
+            .and_raise(self.plugin.RequestFailed("Connection refused"))
+
+        start = time.monotonic()
+        with self.assertRaises(self.plugin.RequestFailed):
+            client.wait_for_compose("42", sleep_time=0.01, unreachable_max=0.1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+        # the same applies while the circuit breaker is open
+        flexmock(client) \
+            .should_receive("compose_status") \
+            .and_raise(self.plugin.CircuitOpen("http://localhost", 0.01))
+
+        with self.assertRaises(self.plugin.CircuitOpen):
+            client.wait_for_compose("42", sleep_time=0.01, unreachable_max=0.1)
+
+        # but successful polls in between start the count again
+        failure = self.plugin.RequestFailed("Connection reset")
+        pending = self.plugin.ComposeStatus.from_dict({
+            "status": "pending",
+            "image_statuses": [{"status": "building"}]
+        })
+        responses = iter([failure, failure, pending, failure, failure, status])
+
+        def compose_status(_compose_id):
+            res = next(responses)
+            if isinstance(res, Exception):
+                raise res
+            return res
+
+        flexmock(client) \
+            .should_receive("compose_status") \
+            .replace_with(compose_status)
+
+        res = client.wait_for_compose("42", sleep_time=0.05, unreachable_max=0.12)
+        self.assertTrue(res.is_success)
+
+    def test_poll_strategy_backoff(self):
+        strategy = self.plugin.BackoffPollStrategy(interval=1,
+                                                   max_interval=5,
+                                                   factor=2,
+                                                   jitter=0)
+
+        delays = [strategy.next_delay(False) for _ in range(5)]
+        self.assertEqual(delays, [1, 2, 4, 5, 5])
+
+        # a change in the status resets the delay
+        self.assertEqual(strategy.next_delay(True), 1)
+
+        # server hints are the minimum, but capped at max_interval
+        self.assertEqual(strategy.next_delay(False, 3), 3)
+        self.assertEqual(strategy.next_delay(False, 300), 5)
+
+        # clones start from scratch and do not share state
+        clone = strategy.clone()
+        self.assertEqual(clone.next_delay(False), 1)
+        self.assertEqual(strategy.next_delay(False), 5)
+
+        # jitter stays within its bounds
+        strategy = self.plugin.BackoffPollStrategy(interval=10, jitter=0.5)
+        for _ in range(10):
+            strategy.reset()
+            delay = strategy.next_delay(False)
+            self.assertTrue(5 <= delay <= 15)
+
+    def test_poll_strategy_config(self):
+        cfg = configparser.ConfigParser()
+        cfg["composer:polling"] = {
+            "strategy": "backoff",
+            "interval": "0.5",
+            "max_interval": "30",
+            "jitter": "0"
+        }
+
+        handler = self.make_handler(config=cfg)
+        strategy = handler.client.poll_strategy
+        self.assertIsInstance(strategy, self.plugin.BackoffPollStrategy)
+        self.assertEqual(strategy.interval, 0.5)
+        self.assertEqual(strategy.max_interval, 30)
+        self.assertEqual(strategy.jitter, 0)
+
+        # the default is to poll with a fixed interval
+        strategy = self.make_handler().client.poll_strategy
+        self.assertEqual(strategy.name, "fixed")
+        self.assertEqual(strategy.next_delay(True), 2)
+
+        # keys of other strategies are ignored
+        cfg["composer:polling"]["strategy"] = "fixed"
+        cfg["composer:polling"]["factor"] = "2"
+        strategy = self.make_handler(config=cfg).client.poll_strategy
+        self.assertEqual(strategy.name, "fixed")
+        self.assertEqual(strategy.next_delay(False), 0.5)
+
+        # as given by the stand alone client
+        strategy = self.plugin.PollStrategy.from_config({
+            "strategy": "fixed",
+            "interval": None,
+            "max_interval": 30
+        })
+        self.assertEqual(strategy.next_delay(False), 2)
+
+        cfg["composer:polling"]["strategy"] = "random"
+        with self.assertRaises(ValueError):
+            self.make_handler(config=cfg)
+
+    def test_poll_hint(self):
+        parse = self.plugin.Client.parse_poll_hint
+
+        self.assertIsNone(parse({}))
+        self.assertEqual(parse({"Retry-After": "7"}), 7)
+        self.assertEqual(parse({"Cache-Control": "private, max-age=12"}), 12)
+        self.assertIsNone(parse({"Cache-Control": "no-cache"}))
+
+        when = email.utils.formatdate(time.time() + 60, usegmt=True)
+        hint = parse({"Retry-After": when})
+        self.assertTrue(50 < hint <= 60)
+
+    @httpretty.activate
+    def test_compose_status_poll_hint(self):
+        compose_id = "43e57e63-ab32-4a8d-854d-3bbc117fdce3"
+
+        result = {
+            "status": "pending",
+            "koji_status": {},
+            "image_statuses": [{"status": "pending"}]
+        }
+
+        httpretty.register_uri(
+            httpretty.GET,
+            urllib.parse.urljoin(f"http://localhost/{API_BASE}", f"composes/{compose_id}"),
+            body=json.dumps(result),
+            adding_headers={"Retry-After": "5"}
+        )
+
+        client = self.plugin.Client("http://localhost")
+        status = client.compose_status(compose_id)
+        self.assertEqual(status.poll_hint, 5)
+
+    def test_status_mux(self):
+        compose_id = "43e57e63-ab32-4a8d-854d-3bbc117fdce3"
+        client = MockStatusClient(self.plugin, compose_id)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mux.sock")
+            mux = self.plugin.StatusMux(client, path)
+            thread = threading.Thread(target=mux.serve, daemon=True)
+            thread.start()
+            self.addCleanup(mux.stop)
+
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.01)
+
+            # only accessible by the user running the multiplexer
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+            # a second multiplexer does not take over the socket
+            with self.assertRaises(koji.GenericError):
+                self.plugin.StatusMux(client, path).serve()
+            self.assertTrue(self.plugin.StatusMux.is_serving(path))
+
+            seen = {0: [], 1: []}
+            results = {}
+
+            def waiter(idx):
+                mc = self.plugin.StatusMuxClient(path)
+                results[idx] = mc.wait_for_compose(compose_id,
+                                                   callback=lambda s: seen[idx].append(s.status))
+
+            waiters = [threading.Thread(target=waiter, args=(i,), daemon=True) for i in seen]
+            for w in waiters:
+                w.start()
+
+            # wait until both tasks are waiting for the same, pending compose
+            for _ in range(100):
+                watch = mux.watches.get(compose_id)
+                if watch and watch.last and len(watch.subscribers) == 2:
+                    break
+                time.sleep(0.01)
+
+            client.release.set()
+            for w in waiters:
+                w.join()
+
+            # only status changes are pushed to the waiting tasks
+            for idx, statuses in seen.items():
+                self.assertEqual(statuses, ["pending", "success"])
+                self.assertTrue(results[idx].is_success)
+                self.assertEqual(results[idx].koji_build_id, 42)
+
+            # errors are forwarded to the task
+            mc = self.plugin.StatusMuxClient(path)
+            with self.assertRaises(koji.GenericError):
+                mc.wait_for_compose("unknown")
+
+            # requests for unknown composers are rejected
+            with self.assertRaises(self.plugin.StatusMuxRejected):
+                mc.wait_for_compose(compose_id, composer="https://unknown.example.com")
+
+            self.assertEqual(mux.watches, {})
+
+            mux.stop()
+            thread.join()
+            self.assertFalse(os.path.exists(path))
+
+            # a stale socket is replaced
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stale.bind(path)
+            stale.close()
+            self.assertFalse(self.plugin.StatusMux.is_serving(path))
+
+            mux = self.plugin.StatusMux(client, path)
+            thread = threading.Thread(target=mux.serve, daemon=True)
+            thread.start()
+            for _ in range(100):
+                if mux.is_serving(path):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(mux.is_serving(path))
+            mux.stop()
+            thread.join()
+
+    def test_status_mux_deadline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mux.sock")
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(1)
+            self.addCleanup(server.close)
+
+            def serve():
+                conn, _ = server.accept()
+                with conn:
+                    conn.makefile("rb").readline()
+                    # a status change shortly before the deadline
+                    time.sleep(0.3)
+                    msg = {"status": {"status": "pending",
+                                      "koji_status": {},
+                                      "image_statuses": [{"status": "pending"}]}}
+                    conn.sendall(json.dumps(msg).encode("utf-8") + b"\n")
+                    time.sleep(1)
+
+            thread = threading.Thread(target=serve, daemon=True)
+            thread.start()
+
+            # the deadline is not extended by the received status
+            mc = self.plugin.StatusMuxClient(path)
+            start = time.monotonic()
+            with self.assertRaises(self.plugin.DeadlineExceeded):
+                mc.wait_for_compose("42", deadline=start + 0.5)
+            self.assertLess(time.monotonic() - start, 0.7)
+            thread.join()
+
+    @httpretty.activate
+    def test_status_mux_unavailable(self):
+        # If the multiplexer is not running, tasks poll on their own
+        cfg = configparser.ConfigParser()
+        cfg["composer:mux"] = {
+            "socket": "/nonexistent/mux.sock"
+        }
+
+        handler = self.make_handler(config=cfg)
+        self.assertEqual(handler.mux_socket, "/nonexistent/mux.sock")
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=["x86_64"])
+        composer.httpretty_register()
+
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                ["x86_64"],
+                {"repo": ["https://1.repo"]}]
+
+        res = handler.handler(*args)
+        assert res, "invalid compose result"
+        self.uploads.assert_upload("compose-status.json")
+
+        # the same if it rejects the request, e.g. since it does not
+        # know the composer of the compose
+        flexmock(self.plugin.StatusMuxClient) \
+            .should_receive("wait_for_compose") \
+            .and_raise(self.plugin.StatusMuxRejected("Unknown composer")) \
+            .once()
+
+        handler = self.make_handler(config=cfg)
+        res = handler.handler(*args)
+        self.assertTrue(res["composer"]["id"])
+        compose = composer.composes[res["composer"]["id"]]
+        self.assertEqual(compose["status"], "success")
+        self.assertFalse(compose.get("canceled"))
+
+    def test_status_update_changes_only(self):
+        handler = self.make_handler()
+
+        def make_status(status):
+            return self.plugin.ComposeStatus.from_dict({
+                "status": status,
+                "koji_status": {"build_id": 42},
+                "image_statuses": [{"status": status}]
+            })
+
+        for status in ["pending", "pending", "building", "building", "success"]:
+            handler.on_status_update(make_status(status))
+
+        # only transitions are uploaded
+        upload = self.uploads.uploads["compose-status.json"]
+        self.assertEqual(upload["count"], 3)
+        status = json.loads(self.uploads.content("compose-status.json"))
+        self.assertEqual(status["status"], "success")
+
+        # the history is only ever appended to
+        upload = self.uploads.uploads["compose-status-history.ndjson"]
+        self.assertEqual(upload["count"], 3)
+        offsets = [offset for offset, _ in upload["writes"]]
+        self.assertEqual(offsets, sorted(set(offsets)))
+        self.assertEqual(offsets[0], 0)
+
+        history = self.uploads.content("compose-status-history.ndjson")
+        entries = [json.loads(line) for line in history.splitlines()]
+        have = [e["status"]["status"] for e in entries]
+        self.assertEqual(have, ["pending", "building", "success"])
+
+    def test_status_timeline(self):
+        handler = self.make_handler()
+        handler.image_names = ["x86_64-image_type", "aarch64-image_type"]
+
+        def make_status(status, images):
+            return self.plugin.ComposeStatus.from_dict({
+                "status": status,
+                "koji_status": {"build_id": 42},
+                "image_statuses": [{"status": s} for s in images]
+            })
+
+        updates = [
+            ("pending", ["pending", "pending"]),
+            ("pending", ["building", "pending"]),
+            ("pending", ["building", "building"]),
+            ("pending", ["building", "building"]),
+            ("pending", ["uploading", "building"]),
+            ("success", ["success", "success"]),
+        ]
+
+        clock = iter(range(100))
+        flexmock(self.plugin.time).should_receive("time").replace_with(lambda: next(clock))
+
+        for status, images in updates:
+            handler.on_status_update(make_status(status, images))
+
+        timeline = self.uploads.content("compose-timeline.ndjson")
+        entries = [json.loads(line) for line in timeline.splitlines()]
+
+        x86 = [e for e in entries if e["name"] == "x86_64-image_type"]
+        self.assertEqual([e["status"] for e in x86],
+                         ["pending", "building", "uploading", "success"])
+        self.assertIsNone(x86[0]["previous"])
+        self.assertNotIn("duration", x86[0])
+        self.assertEqual(x86[1]["previous"], "pending")
+
+        compose = [e for e in entries if e["name"] == "compose"]
+        self.assertEqual([e["status"] for e in compose], ["pending", "success"])
+
+        # every transition is only appended
+        upload = self.uploads.uploads["compose-timeline.ndjson"]
+        self.assertEqual(upload["count"], len(entries))
+
+        # time spent in a phase is accumulated
+        durations = handler.phase_durations["x86_64-image_type"]
+        self.assertEqual(set(durations.keys()), {"pending", "building", "uploading"})
+        self.assertTrue(all(d > 0 for d in durations.values()))
+
+    def test_upload_outputs(self):
+        session = self.mock_session()
+        handler = self.make_handler(session=session)
+        self.assertEqual(handler.upload_workers, handler.UPLOAD_WORKERS)
+
+        subsessions = []
+
+        def subsession():
+            sub = flexmock()
+            sub.should_receive("logout").once()
+            subsessions.append(sub)
+            return sub
+
+        session.should_receive("subsession").replace_with(subsession)
+
+        # the task session is only used by the calling thread
+        main = threading.current_thread()
+
+        class MainThreadOnly:
+            def __getattr__(self, name):
+                if threading.current_thread() is not main:
+                    raise AssertionError(f"Task session used by another thread: {name}")
+                return getattr(session, name)
+
+        handler.session = MainThreadOnly()
+
+        outputs = [({"index": i}, f"output-{i}") for i in range(10)]
+        handler.upload_outputs(outputs)
+
+        for i in range(10):
+            name = f"output-{i}.json"
+            self.uploads.assert_upload(name)
+            data = json.loads(self.uploads.content(name))
+            self.assertEqual(data, {"index": i})
+
+        # one subsession per worker, all of them logged out
+        self.assertEqual(len(subsessions), handler.UPLOAD_WORKERS)
+
+        # a single worker uploads with the main session
+        cfg = configparser.ConfigParser()
+        cfg["koji"] = {
+            "upload_workers": "1"
+        }
+        session.should_receive("subsession").never()
+        handler = self.make_handler(config=cfg, session=session)
+        self.assertEqual(handler.upload_workers, 1)
+        handler.upload_outputs(outputs)
+
+    def test_client_registry(self):
+        cfg = configparser.ConfigParser()
+        cfg["composer"] = {
+            "server": "https://composer.osbuild.org",
+            "ssl_verify": "false"
+        }
+
+        # handlers with the same composer config share the client
+        first = self.make_handler(config=cfg)
+        second = self.make_handler(config=cfg)
+        self.assertIs(first.client, second.client)
+
+        cfg["composer"]["ssl_verify"] = "true"
+        third = self.make_handler(config=cfg)
+        self.assertIsNot(first.client, third.client)
+
+        # connection pools can be dropped, e.g. after a fork
+        adapter = first.client.http.get_adapter(first.client.server)
+        adapter.poolmanager.connection_from_url(first.client.server)
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+        self.plugin.CLIENTS.reset_connections()
+        self.assertEqual(len(adapter.poolmanager.pools), 0)
+
+    def test_token_bucket(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "admission.json")
+            bucket = self.plugin.TokenBucket(path, rate=10, burst=2)
+
+            # the burst is available right away, shared by all users
+            self.assertEqual(bucket.take(), 0)
+            other = self.plugin.TokenBucket(path, rate=10, burst=2)
+            self.assertEqual(other.take(), 0)
+
+            wait = bucket.take()
+            self.assertGreater(wait, 0)
+            self.assertLessEqual(wait, 0.1)
+
+            waited = bucket.acquire()
+            self.assertGreater(waited, 0)
+
+            # no token in time
+            with self.assertRaises(koji.GenericError):
+                bucket.acquire(deadline=time.monotonic())
+
+    @httpretty.activate
+    def test_compose_admission(self):
+        arches = ["x86_64"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {"repo": ["https://1.repo"]}]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = configparser.ConfigParser()
+            cfg["composer"] = {"server": url}
+            cfg["composer:admission"] = {
+                "state": os.path.join(tmp, "admission.json"),
+                "rate": "10",
+            }
+            cfg["koji"] = {"server": self.plugin.DEFAULT_KOJIHUB_URL}
+
+            for _ in range(2):
+                handler = self.make_handler(config=cfg)
+                res = handler.handler(*args)
+                assert res, "invalid compose result"
+
+        # the time spent waiting for admission is part of the timeline
+        entries = [json.loads(line)
+                   for line in self.uploads.content("compose-timeline.ndjson").splitlines()]
+        self.assertEqual(entries[0]["name"], "compose")
+        self.assertEqual(entries[0]["status"], "queued")
+        self.assertEqual(entries[1]["previous"], "queued")
+        # the second task had to wait for the next token
+        self.assertGreater(handler.phase_durations["compose"]["queued"], 0.05)
+
+    @httpretty.activate
+    def test_composer_pool(self):
+        arches = ["x86_64"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {"repo": ["https://1.repo"]}]
+
+        first = MockComposer("https://composer-a.example.com", architectures=arches)
+        first.httpretty_register()
+        second = MockComposer("https://composer-b.example.com", architectures=arches)
+        second.httpretty_register()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = configparser.ConfigParser()
+            cfg["composer"] = {
+                "server": "https://composer-a.example.com, https://composer-b.example.com"
+            }
+            cfg["composer:balancing"] = {"state": os.path.join(tmp, "balancing.json")}
+            cfg["koji"] = {"server": self.plugin.DEFAULT_KOJIHUB_URL}
+
+            handler = self.make_handler(config=cfg)
+            pool = handler.composers
+            self.assertEqual([c.server for c in pool.clients],
+                             ["https://composer-a.example.com",
+                              "https://composer-b.example.com"])
+
+            # unhealthy composers are not used
+            first.healthy = False
+            res = handler.handler(*args)
+            self.assertEqual(res["composer"]["server"], "https://composer-b.example.com")
+            self.assertEqual(len(second.composes), 1)
+
+            # the one with fewer outstanding composes is used
+            first.healthy = True
+            pool.begin("https://composer-b.example.com", "busy")
+            handler = self.make_handler(config=cfg)
+            res = handler.handler(*args)
+            compose_id = res["composer"]["id"]
+            self.assertEqual(res["composer"]["server"], "https://composer-a.example.com")
+            self.assertEqual(len(first.composes), 1)
+
+            # a resumed compose sticks to its composer
+            pool.end("https://composer-b.example.com", "busy")
+            pool.begin("https://composer-a.example.com", "busy")
+
+            session = self.mock_session()
+            session.should_receive("downloadTaskOutput") \
+                   .with_args(1, "compose-id.json") \
+                   .and_return(self.uploads.content("compose-id.json").encode("utf-8"))
+
+            handler = self.make_handler(config=cfg, session=session)
+            res = handler.handler(*args)
+            self.assertEqual(res["composer"]["id"], compose_id)
+            self.assertEqual(res["composer"]["server"], "https://composer-a.example.com")
+
+            # no healthy composer at all
+            first.healthy = second.healthy = False
+            handler = self.make_handler(config=cfg)
+            with self.assertRaises(koji.GenericError):
+                handler.handler(*args)
+
+    @httpretty.activate
+    def test_composer_routes(self):
+        arches = ["x86_64", "aarch64"]
+
+        def make_args(arches, image_type="image_type"):
+            return ["name", "version", "distro",
+                    image_type,
+                    "fedora-candidate",
+                    arches,
+                    {"repo": ["https://1.repo"]}]
+
+        first = MockComposer("https://composer-a.example.com", architectures=arches)
+        first.httpretty_register()
+        second = MockComposer("https://composer-b.example.com", architectures=arches)
+        second.httpretty_register()
+
+        cfg = configparser.ConfigParser()
+        cfg["composer"] = {"server": "https://composer-a.example.com"}
+        cfg["composer:routes"] = {
+            "x86_64": "https://composer-a.example.com",
+            "aarch64": "https://composer-b.example.com",
+            "aarch64/edge-commit": "https://composer-a.example.com, https://composer-b.example.com"
+        }
+        cfg["koji"] = {"server": self.plugin.DEFAULT_KOJIHUB_URL}
+
+        # composers only given in routes are part of the pool
+        handler = self.make_handler(config=cfg)
+        self.assertEqual([c.server for c in handler.composers.clients],
+                         ["https://composer-a.example.com",
+                          "https://composer-b.example.com"])
+
+        res = handler.handler(*make_args(["x86_64"]))
+        self.assertEqual(res["composer"]["server"], "https://composer-a.example.com")
+
+        handler = self.make_handler(config=cfg)
+        res = handler.handler(*make_args(["aarch64"]))
+        self.assertEqual(res["composer"]["server"], "https://composer-b.example.com")
+
+        # the route of the image type takes precedence over the one of the arch
+        handler = self.make_handler(config=cfg)
+        res = handler.handler(*make_args(["x86_64", "aarch64"], "edge-commit"))
+        self.assertEqual(res["composer"]["server"], "https://composer-a.example.com")
+
+        # images of disjoint shards can not be part of the same compose
+        composes = len(first.composes) + len(second.composes)
+        handler = self.make_handler(config=cfg)
+        with self.assertRaises(koji.BuildError):
+            handler.handler(*make_args(arches))
+        self.assertEqual(len(first.composes) + len(second.composes), composes)
+
+    def test_client_timeouts(self):
+        cfg = configparser.ConfigParser()
+        cfg["composer"] = {"server": "https://localhost"}
+        cfg["composer:oauth"] = {
+            "client_id": "koji-osbuild",
+            "client_secret": "s3cr3t",
+            "token_url": "https://localhost/token"
+        }
+        cfg["composer:timeouts"] = {"connect": "1", "read": "2"}
+
+        client = self.plugin.make_client(cfg, flexmock(debug=lambda *args: None))
+        self.assertEqual(client.timeout, (1.0, 2.0))
+        self.assertEqual(client.http.auth.timeout, (1.0, 2.0))
+
+        # all requests use the timeouts, timeouts result in a clear error
+        client.http.auth = None
+        flexmock(client.http) \
+            .should_receive("request") \
+            .with_args("GET", str, json=None, timeout=(1.0, 2.0)) \
+            .and_raise(requests.exceptions.ReadTimeout("read timed out")) \
+            .once()
+
+        with self.assertRaises(self.plugin.RequestFailed) as err:
+            client.compose_status("42")
+        self.assertIn("timed out", str(err.exception))
+
+    @httpretty.activate
+    def test_client_retries(self):
+        url = "https://composer.example.com"
+        cfg = configparser.ConfigParser()
+        cfg["composer"] = {"server": url}
+        cfg["composer:retries"] = {
+            "total": "1",
+            "backoff_factor": "0.5",
+            "jitter": "0.2",
+            "status": "429, 503"
+        }
+
+        client = self.plugin.make_client(cfg, flexmock(debug=lambda *args: None))
+        retry = client.http.get_adapter(url).max_retries
+        self.assertEqual(retry.total, 1)
+        self.assertEqual(retry.status_forcelist, [429, 503])
+
+        # the backoff time varies by the jitter
+        retry = retry.new(history=(flexmock(redirect_location=None),) * 2)
+        for _ in range(10):
+            self.assertGreaterEqual(retry.get_backoff_time(), 0.8)
+            self.assertLessEqual(retry.get_backoff_time(), 1.2)
+
+        # rate limited requests are retried, even POST ones, after the
+        # time given via `Retry-After`
+        compose_url = urllib.parse.urljoin(client.url, "compose")
+        httpretty.register_uri(
+            httpretty.POST,
+            compose_url,
+            responses=[
+                httpretty.Response(status=429, body="slow down",
+                                   adding_headers={"Retry-After": "1"}),
+                httpretty.Response(status=201, body='{"id": "42"}')
+            ]
+        )
+
+        start = time.monotonic()
+        res = client.post(compose_url, js={})
+        self.assertEqual(res.status_code, 201)
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+
+        # other errors are still not retried for POST
+        httpretty.register_uri(
+            httpretty.POST,
+            compose_url,
+            responses=[
+                httpretty.Response(status=503, body="unavailable"),
+                httpretty.Response(status=201, body='{"id": "43"}')
+            ]
+        )
+        res = client.post(compose_url, js={})
+        self.assertEqual(res.status_code, 503)
+
+        # unless 429 is not one of the status codes to retry
+        cfg["composer:retries"]["status"] = "503"
+        client = self.plugin.make_client(cfg, flexmock(debug=lambda *args: None))
+        httpretty.register_uri(
+            httpretty.POST,
+            compose_url,
+            responses=[
+                httpretty.Response(status=429, body="slow down",
+                                   adding_headers={"Retry-After": "1"}),
+                httpretty.Response(status=201, body='{"id": "44"}')
+            ]
+        )
+        res = client.post(compose_url, js={})
+        self.assertEqual(res.status_code, 429)
+
+        # an empty list disables retrying based on the status
+        cfg["composer:retries"]["status"] = ""
+        client = self.plugin.make_client(cfg, flexmock(debug=lambda *args: None))
+        retry = client.http.get_adapter(url).max_retries
+        self.assertFalse(retry.status_forcelist)
+
+        # and without any, the defaults are used
+        del cfg["composer:retries"]["status"]
+        client = self.plugin.make_client(cfg, flexmock(debug=lambda *args: None))
+        retry = client.http.get_adapter(url).max_retries
+        self.assertEqual(retry.status_forcelist, client.RETRY_STATUS)
+
+    @httpretty.activate
+    def test_circuit_breaker(self):
+        url = "https://composer.example.com"
+        composer = MockComposer(url)
+        composer.httpretty_register()
+        composer.healthy = False
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cfg = configparser.ConfigParser()
+            cfg["composer"] = {"server": url}
+            cfg["composer:breaker"] = {
+                "threshold": "2",
+                "reset_timeout": "0.2",
+                "state": os.path.join(tmp, "breaker.json")
+            }
+
+            logger = flexmock(debug=lambda *args: None)
+            client = self.plugin.make_client(cfg, logger)
+
+            # the breaker opens after `threshold` failed requests
+            for _ in range(2):
+                with self.assertRaises(koji.GenericError) as err:
+                    client.health_check()
+                self.assertNotIsInstance(err.exception, self.plugin.CircuitOpen)
+
+            with self.assertRaises(self.plugin.CircuitOpen):
+                client.health_check()
+
+            # ... for all tasks on the host
+            other = self.plugin.make_client(cfg, logger)
+            with self.assertRaises(self.plugin.CircuitOpen):
+                other.health_check()
+
+            stats = client.breaker.stats()
+            self.assertEqual(stats["state"], "open")
+            self.assertEqual(stats["trips"], 1)
+            self.assertEqual(stats["rejected"], 2)
+
+            # a failed probe opens it again
+            time.sleep(0.25)
+            with self.assertRaises(koji.GenericError) as err:
+                client.health_check()
+            self.assertNotIsInstance(err.exception, self.plugin.CircuitOpen)
+            with self.assertRaises(self.plugin.CircuitOpen):
+                client.health_check()
+            self.assertEqual(client.breaker.stats()["trips"], 2)
+
+            # a successful one closes it
+            composer.healthy = True
+            time.sleep(0.25)
+            client.health_check()
+            other.health_check()
+            stats = other.breaker.stats()
+            self.assertEqual(stats["state"], "closed")
+            self.assertEqual(stats["failures"], 0)
+
+            # a threshold of 0 disables the breaker
+            cfg["composer:breaker"]["threshold"] = "0"
+            self.assertIsNone(self.plugin.make_client(cfg, logger).breaker)
+
+    @httpretty.activate
+    def test_circuit_breaker_wait(self):
+        compose_id = "43e57e63-ab32-4a8d-854d-3bbc117fdce3"
+        MockComposerStatus(compose_id).httpretty_register()
+
+        client = self.plugin.Client("http://localhost")
+        client.breaker = self.plugin.CircuitBreaker(client.server,
+                                                    threshold=1,
+                                                    reset_timeout=0.2)
+        client.breaker.record(False)
+
+        # waiting is paused, but does not fail, while the breaker is open
+        start = time.monotonic()
+        status = client.wait_for_compose(compose_id, sleep_time=0.01)
+        self.assertTrue(status.is_success)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(client.breaker.stats()["state"], "closed")
+
+        # unless the deadline is reached before
+        client.breaker.record(False)
+        with self.assertRaises(self.plugin.DeadlineExceeded):
+            client.wait_for_compose(compose_id, deadline=time.monotonic() + 0.05)
+
+    @httpretty.activate
+    def test_compose_deadline(self):
+        arches = ["x86_64"]
+        args = ["name", "version", "distro",
+                "image_type",
+                "fedora-candidate",
+                arches,
+                {"repo": ["https://1.repo"]}]
+
+        url = self.plugin.DEFAULT_COMPOSER_URL
+        composer = MockComposer(url, architectures=arches)
+        composer.httpretty_register()
+        composer.status = "pending"
+
+        cfg = configparser.ConfigParser()
+        cfg["composer"] = {"server": url}
+        cfg["composer:polling"] = {"interval": "0.05"}
+        cfg["composer:timeouts"] = {"deadline": "0.3"}
+        cfg["koji"] = {"server": self.plugin.DEFAULT_KOJIHUB_URL}
+
+        handler = self.make_handler(config=cfg)
+
+        start = time.monotonic()
+        with self.assertRaises(self.plugin.DeadlineExceeded):
+            handler.handler(*args)
+        self.assertLess(time.monotonic() - start, 5)
+
+        # the compose got canceled
+        compose_id = json.loads(self.uploads.content("compose-id.json"))["compose_id"]
+        self.assertTrue(composer.composes[compose_id].get("canceled"))
+
+    def test_oauth2_shared_token(self):
+        client = self.plugin.Client("https://localhost")
+        client.oauth_init("koji-osbuild", "s3cr3t", "https://localhost/token")
+        auth = client.http.auth
+
+        def fetch_token(_http, **_kwargs):
+            time.sleep(0.1)
+            auth.token = self.plugin.OAuth2.Token({
+                "access_token": "token",
+                "token_type": "Bearer",
+                "expires_in": 60
+            }, time.time())
+
+        flexmock(auth).should_receive("fetch_token").replace_with(fetch_token).once()
+
+        # threads sharing the client only fetch the token once
+        threads = [threading.Thread(target=client.oauth_check) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertFalse(auth.token_expired)
+
+    def test_config_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "builder.conf")
+            files = [path, os.path.join(tmp, "missing.conf")]
+
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("[composer]\nserver = https://first.osbuild.org\n")
+
+            cfg = self.plugin.read_config(files)
+            self.assertEqual(cfg["composer"]["server"], "https://first.osbuild.org")
+
+            # unchanged files are not parsed again
+            self.assertIs(self.plugin.read_config(files), cfg)
+
+            # a change of the content is picked up
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("[composer]\nserver = https://second.osbuild.org\n")
+
+            cfg = self.plugin.read_config(files)
+            self.assertEqual(cfg["composer"]["server"], "https://second.osbuild.org")
+
+            # as is a change of only the modification time
+            st = os.stat(path)
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+            changed = self.plugin.read_config(files)
+            self.assertIsNot(changed, cfg)
+
+            # and new files
+            with open(files[1], "w", encoding="utf-8") as f:
+                f.write("[koji]\nserver = https://koji.osbuild.org/kojihub\n")
+
+            cfg = self.plugin.read_config(files)
+            self.assertEqual(cfg["composer"]["server"], "https://second.osbuild.org")
+            self.assertEqual(cfg["koji"]["server"], "https://koji.osbuild.org/kojihub")
+
+    @httpretty.activate
+    def test_oauth2_token_cache(self):
+        token_url = "https://localhost/token"
+        calls = []
+
+        def acquire_token(_request, _uri, response_headers):
+            calls.append(time.time())
+            token = {
+                "access_token": str(uuid.uuid4()),
+                "expires_in": 60,
+                "token_type": "Bearer",
+            }
+            return [200, response_headers, json.dumps(token)]
+
+        httpretty.register_uri(httpretty.POST, token_url, body=acquire_token)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = os.path.join(tmp, "cache", "token.json")
+
+            # clients in different processes, sharing the cache
+            clients = []
+            for _ in range(3):
+                client = self.plugin.Client("https://localhost")
+                client.oauth_init("koji-osbuild", "s3cr3t", token_url, cache=cache)
+                clients.append(client)
+
+            for client in clients:
+                self.assertTrue(client.oauth_check())
+
+            self.assertEqual(len(calls), 1)
+            tokens = {c.http.auth.token.data for c in clients}
+            self.assertEqual(len(tokens), 1)
+            self.assertEqual(os.stat(cache).st_mode & 0o777, 0o600)
+
+            # a rejected token is not taken from the cache again
+            first, second = clients[0], clients[1]
+            first.oauth_check(force_new_token=True)
+            self.assertEqual(len(calls), 2)
+            self.assertNotIn(first.http.auth.token.data, tokens)
+
+            # but the new token is used by the others
+            second.oauth_check(force_new_token=True)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(second.http.auth.token.data,
+                             first.http.auth.token.data)
+
+    def test_oauth2_proactive_refresh(self):
+        oauth = self.plugin.OAuth2("koji-osbuild", "s3cr3t", "https://localhost/token",
+                                   refresh_at=0.5)
+        data = {
+            "access_token": "token",
+            "token_type": "Bearer",
+            "expires_in": 60
+        }
+
+        oauth.token = oauth.Token(data, time.time() - 20)
+        self.assertFalse(oauth.token_expired)
+
+        # not yet expired, but past the refresh point
+        oauth.token = oauth.Token(data, time.time() - 40)
+        self.assertFalse(oauth.token.expired)
+        self.assertTrue(oauth.token_expired)
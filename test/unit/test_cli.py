@@ -7,6 +7,8 @@ import contextlib
 import io
 import json
 import os
+import subprocess
+import sys
 import tempfile
 
 import koji
@@ -66,6 +68,30 @@ class TestCliPlugin(PluginTest):
 
         return session
 
+    def test_import_time(self):
+        # The plugin is loaded for every `koji` invocation, make sure
+        # loading it does not import anything besides what the koji
+        # command line tool itself already imported at that point.
+        root = os.getenv("GITHUB_WORKSPACE", os.getcwd())
+        path = os.path.join(root, "plugins", "cli", "osbuild.py")
+
+        script = (
+            "import importlib.util, sys\n"
+            "import koji, koji.plugin, koji_cli.lib, koji_cli.commands\n"
+            "print('-- plugin --', file=sys.stderr, flush=True)\n"
+            f"spec = importlib.util.spec_from_file_location('osbuild', {path!r})\n"
+            "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+        )
+
+        r = subprocess.run([sys.executable, "-X", "importtime", "-c", script],
+                           encoding="utf-8", capture_output=True, check=True)
+
+        _, _, output = r.stderr.partition("-- plugin --\n")
+        imported = [line.split("|")[-1].strip()
+                    for line in output.splitlines()
+                    if line.startswith("import time:")]
+        self.assertEqual(imported, [])
+
     def test_basic_invocation(self):
         # check we get the right amount of arguments
         # i.e. we are missing the architecture here
@@ -88,7 +114,8 @@ class TestCliPlugin(PluginTest):
             "--repo", "https://first.repo",
             "--repo", "https://second.repo",
             "--release", "20200202.n2",
-            "--skip-tag"
+            "--skip-tag",
+            "--fail-fast"
         ]
 
         expected_args = ["name", "version", "distro",
@@ -99,7 +126,8 @@ class TestCliPlugin(PluginTest):
         expected_opts = {
             "release": "20200202.n2",
             "repo": ["https://first.repo", "https://second.repo"],
-            "skip_tag": True
+            "skip_tag": True,
+            "fail_fast": True
         }
 
         task_result = {"compose_id": "42", "build_id": 23}
@@ -343,3 +371,177 @@ class TestCliPlugin(PluginTest):
         argv = ["name", "version", "distro", "target", "arch1"]
         with self.assertRaises(koji.GenericError):
             self.plugin.handle_osbuild_image(None, session, argv)
+
+    @staticmethod
+    def write_image_specs(tmpdir, specs, name="images.json"):
+        path = os.path.join(tmpdir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            if name.endswith(".json"):
+                json.dump(specs, f)
+            else:
+                # YAML is a superset of JSON
+                f.write(json.dumps(specs, indent=2))
+        return path
+
+    def test_from_file(self):
+        specs = [
+            {"name": "a", "version": "1", "distro": "d", "target": "target",
+             "arches": ["x86_64"]},
+            {"name": "b", "version": "1", "distro": "d", "target": "target",
+             "arches": ["aarch64"], "image_type": "ami", "opts": {"skip_tag": True}},
+            {"name": "c", "version": "1", "distro": "d", "target": "target",
+             "arches": ["s390x"]},
+        ]
+
+        expected = [
+            {"image_type": "guest-image", "opts": {}, **specs[0]},
+            specs[1],
+            {"image_type": "guest-image", "opts": {}, **specs[2]},
+        ]
+
+        for name in ("images.json", "images.yaml"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = self.write_image_specs(tmpdir, specs, name)
+
+                koji_lib = self.mock_koji_lib()
+                koji_lib.should_receive("watch_tasks") \
+                        .with_args(object, [1, 3], quiet=False) \
+                        .and_return(0) \
+                        .once()
+
+                session = flexmock()
+                # the target is only checked once
+                self.mock_session_add_valid_tag(session)
+
+                session.should_receive("osbuildImageBatch") \
+                       .with_args(expected) \
+                       .and_return([{"task_id": 1}, {"error": "bad"}, {"task_id": 3}]) \
+                       .once()
+
+                session.should_receive("logout").once()
+
+                setattr(self.plugin, "kl", koji_lib)
+                f = io.StringIO()
+                with contextlib.redirect_stdout(f):
+                    r = self.plugin.handle_osbuild_image(self.mock_options(), session,
+                                                         ["--from-file", path])
+                # one image failed
+                self.assertEqual(r, 1)
+                self.assertIn("Failed to create task for b-1", f.getvalue())
+
+    def test_from_file_multicall(self):
+        specs = [
+            {"name": "a", "version": "1", "distro": "d", "target": "target",
+             "arches": ["x86_64"]},
+            {"name": "b", "version": "1", "distro": "d", "target": "target",
+             "arches": ["aarch64"], "opts": {"release": "1"}},
+        ]
+
+        calls = []
+
+        class MultiCall:
+            def __init__(self, **kwargs):
+                self.kwargs = kwargs
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            @staticmethod
+            def osbuildImage(*args, **kwargs):
+                calls.append((args, kwargs))
+                return flexmock(result=len(calls))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self.write_image_specs(tmpdir, specs)
+
+            koji_lib = self.mock_koji_lib()
+            koji_lib.should_receive("watch_tasks") \
+                    .with_args(object, [1, 2], quiet=True) \
+                    .and_return(0) \
+                    .once()
+
+            session = flexmock(multicall=MultiCall)
+            self.mock_session_add_valid_tag(session)
+
+            # an older hub without the batch call
+            session.should_receive("osbuildImageBatch") \
+                   .and_raise(koji.GenericError("Invalid method: osbuildImageBatch")) \
+                   .once()
+
+            session.should_receive("logout").once()
+
+            setattr(self.plugin, "kl", koji_lib)
+            r = self.plugin.handle_osbuild_image(self.mock_options(quiet=True), session,
+                                                 ["--from-file", path])
+            self.assertEqual(r, 0)
+
+        self.assertEqual(calls, [
+            (("a", "1", "d", "guest-image", "target", ["x86_64"]), {"opts": {}}),
+            (("b", "1", "d", "guest-image", "target", ["aarch64"]), {"opts": {"release": "1"}}),
+        ])
+
+    def test_from_file_defaults(self):
+        specs = [
+            {"name": "a", "version": "1", "distro": "d", "target": "target",
+             "arches": ["x86_64"]},
+            {"name": "b", "version": "1", "distro": "d", "target": "target",
+             "arches": ["aarch64"], "image_type": "ami", "opts": {"release": "2"}},
+        ]
+
+        # the options are the defaults for all images
+        defaults = {
+            "release": "1",
+            "repo": ["https://first.repo"],
+            "skip_tag": True,
+            "fail_fast": True,
+            "ostree": {"ref": "test/ref"},
+        }
+
+        expected = [
+            {"image_type": "edge-commit", **specs[0], "opts": defaults},
+            {**specs[1], "opts": {**defaults, "release": "2"}},
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self.write_image_specs(tmpdir, specs)
+
+            koji_lib = self.mock_koji_lib()
+
+            session = flexmock()
+            self.mock_session_add_valid_tag(session)
+
+            session.should_receive("osbuildImageBatch") \
+                   .with_args(expected) \
+                   .and_return([{"task_id": 1}, {"task_id": 2}]) \
+                   .once()
+
+            setattr(self.plugin, "kl", koji_lib)
+            r = self.plugin.handle_osbuild_image(self.mock_options(quiet=True), session,
+                                                 ["--from-file", path,
+                                                  "--image-type", "edge-commit",
+                                                  "--release", "1",
+                                                  "--repo", "https://first.repo",
+                                                  "--skip-tag",
+                                                  "--fail-fast",
+                                                  "--ostree-ref", "test/ref",
+                                                  "--nowait"])
+            self.assertEqual(r, None)
+
+    def test_from_file_invalid(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = self.write_image_specs(tmpdir, [{"name": "a", "arch": ["x86_64"]}])
+
+            with self.assertRaises(koji.GenericError):
+                self.plugin.handle_osbuild_image(None, None, ["--from-file", path])
+
+            path = self.write_image_specs(tmpdir, [{"name": "a"}])
+            with self.assertRaises(koji.GenericError):
+                self.plugin.handle_osbuild_image(None, None, ["--from-file", path])
+
+            # positional arguments are not allowed
+            f = io.StringIO()
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(f):
+                self.plugin.handle_osbuild_image(None, None, ["--from-file", path, "name"])
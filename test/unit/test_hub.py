@@ -2,6 +2,10 @@
 # koji hub plugin unit tests
 #
 
+import os
+import timeit
+import unittest
+
 import jsonschema
 import koji
 from flexmock import flexmock
@@ -45,7 +49,8 @@ class TestHubPlugin(PluginTest):
         opts = {
             "repo": ["repo1", "repo2"],
             "release": "1.2.3",
-            "skip_tag": True
+            "skip_tag": True,
+            "fail_fast": True
         }
         args = [
             "name",
@@ -139,3 +144,124 @@ class TestHubPlugin(PluginTest):
             with self.subTest(idx=idx):
                 with self.assertRaises(koji.ParameterError):
                     self.plugin.osbuildImage(*test_case["args"], test_case["opts"])
+
+    def test_validator(self):
+        # Validation via the pre-built validator must give the same
+        # result as `jsonschema.validate`
+        args = [
+            "name",
+            "version",
+            "distro",
+            "image_type",
+            "target",
+            ["x86_64", "aarch64"],
+            {
+                "repo": ["repo1", {"baseurl": "repo2", "package_sets": ["os"]}],
+                "upload_options": {
+                    "region": "us-east-1",
+                    "share_with_accounts": ["123456789"]
+                }
+            }
+        ]
+
+        schema = self.plugin.OSBUILD_IMAGE_SCHEMA
+        jsonschema.validate(args, schema)
+        self.plugin.validate_args(args)
+
+        bad = args[:6] + [{"repo": [{"package_sets": ["os"]}]}]
+        with self.assertRaises(jsonschema.exceptions.ValidationError) as want:
+            jsonschema.validate(bad, schema)
+        with self.assertRaises(koji.ParameterError) as have:
+            self.plugin.validate_args(bad)
+        self.assertEqual(str(have.exception), str(want.exception))
+
+    @unittest.skipUnless(os.getenv("KOJI_OSBUILD_BENCHMARK"),
+                         "benchmark, set KOJI_OSBUILD_BENCHMARK=1 to run it")
+    def test_validator_benchmark(self):
+        # Cost of a single validation of typical arguments, via
+        # `jsonschema.validate` and via the pre-built validator
+        args = [
+            "name",
+            "version",
+            "distro",
+            "image_type",
+            "target",
+            ["x86_64", "aarch64"],
+            {
+                "repo": ["repo1", {"baseurl": "repo2", "package_sets": ["os"]}],
+                "upload_options": {
+                    "region": "us-east-1",
+                    "share_with_accounts": ["123456789"]
+                }
+            }
+        ]
+
+        schema = self.plugin.OSBUILD_IMAGE_SCHEMA
+        n = 200
+        baseline = timeit.timeit(lambda: jsonschema.validate(args, schema), number=n)
+        cached = timeit.timeit(lambda: self.plugin.validate_args(args), number=n)
+        print(f"\nvalidation per call: jsonschema.validate {baseline / n * 1e6:.0f}us, "
+              f"pre-built validator {cached / n * 1e6:.0f}us")
+
+    def test_batch(self):
+        context = self.mock_koji_context()
+        setattr(self.plugin, "context", context)
+
+        opts = {"repo": ["repo1"], "skip_tag": True}
+        valid = {
+            "name": "name",
+            "version": "version",
+            "distro": "distro",
+            "image_type": ["image_type"],
+            "target": "target",
+            "arches": ["x86_64"],
+            "opts": opts
+        }
+
+        images = [
+            valid,
+            dict(valid, image_type=["a", "b"]),  # only one image type
+            dict(valid, arches=["aarch64"]),
+            dict(valid, extra=True),  # unknown key
+            "not-a-dict",
+        ]
+
+        created = []
+
+        def make_task(method, args, **task):
+            self.assertEqual(method, "osbuildImage")
+            self.assertEqual(task, {"channel": "image"})
+            created.append(args)
+            return 100 + len(created)
+
+        kojihub = flexmock(make_task=make_task)
+        setattr(self.plugin, "kojihub", kojihub)
+
+        res = self.plugin.osbuildImageBatch(images)
+
+        self.assertEqual(len(res), len(images))
+        self.assertEqual(res[0], {"task_id": 101})
+        self.assertIn("error", res[1])
+        self.assertEqual(res[2], {"task_id": 102})
+        self.assertIn("extra", res[3]["error"])
+        self.assertIn("error", res[4])
+
+        # image types are normalized like for `osbuildImage`
+        self.assertEqual(created[0],
+                         ["name", "version", "distro", "image_type",
+                          "target", ["x86_64"], opts])
+        self.assertEqual(created[1][5], ["aarch64"])
+
+    def test_batch_priority(self):
+        context = self.mock_koji_context(times=2, admin=False)
+        setattr(self.plugin, "context", context)
+
+        kojihub = flexmock()
+        kojihub.should_receive("make_task").never()
+        setattr(self.plugin, "kojihub", kojihub)
+
+        with self.assertRaises(koji.ActionNotAllowed):
+            self.plugin.osbuildImageBatch([], priority=-1)
+
+        with self.assertRaises(koji.ParameterError):
+            self.plugin.osbuildImageBatch({})